@@ -5,6 +5,10 @@ Monitor local cgroups as used by Docker, LXC, SystemD, ...
 
 Usage:
   ctop [--tree] [--refresh=<seconds>] [--columns=<columns>] [--sort-col=<sort-col>] [--follow=<name>] [--fold=<cgroup>, ...]
+  ctop [--jsonl=<file>] [--listen=<address>] [--refresh=<seconds>] [--type=<type>, ...]
+  ctop --replay=<file> [--speed=<factor>] [--tree] [--columns=<columns>] [--sort-col=<sort-col>]
+  ctop --serve=<address> [--refresh=<seconds>]
+  ctop --connect=<address> [--connect=<address>, ...] [--tree] [--columns=<columns>] [--sort-col=<sort-col>]
   ctop (-h | --help)
 
 Options:
@@ -12,9 +16,25 @@ Options:
   --fold=<name>          Start with <name> cgroup path folded
   --follow=<name>        Follow/highlight cgroup at path.
   --refresh=<seconds>    Refresh display every <seconds> [default: 1].
+  --intervals=<list>     Per metric sampling intervals, like 'cpu=0.5,owner=30'. Metrics: cpu, memory, blkio, pids, owner, openvz.
+                         Owner/type lookups and openvz default to every 10s.
+  --adaptive             Stretch the interval of metrics whose sampling exceeds 10% of it.
   --columns=<columns>    List of optional columns to display. Always includes 'name'. [default: owner,processes,memory,cpu-sys,cpu-user,blkio,cpu-time].
   --sort-col=<sort-col>  Select column to sort by initially. Can be changed dynamically. [default: cpu-user]
   --type=[types]         Only keep containers of this types
+  --history=<samples>    Number of refreshes kept in history columns [default: 60].
+  --record=<file>        Record raw measures to <file>
+  --replay=<file>        Replay measures recorded in <file>. Seek with Left/Right, [/], speed with </>
+  --speed=<factor>       Replay speed factor [default: 1]
+  --timings              Print average time per phase on exit. Press 't' for a live overlay.
+  --profile=<file>       Save a cProfile dump to <file> on exit
+  --jsonl=<file>         Headless: append one JSON record per refresh to <file>, '-' for stdout
+  --listen=<address>     Headless: serve Prometheus metrics on [<address>:]<port>/metrics
+  --serve=<address>      Headless agent: stream measures to viewers on [<address>:]<port> or a unix socket path
+  --connect=<address>    Viewer: merge the agent at [<label>=][<address>:]<port> or a unix socket path
+  --alert=<rule>         Alert when '<field> <op> <value>[%|K|M|G|T] [for <N>s]', like 'cpu_total > 90% for 30s'
+  --alert-log=<file>     Append alert events as JSON Lines to <file>
+  --alert-webhook=<url>  POST alert events as JSON to <url>
   -h --help              Show this screen.
 
 '''
@@ -28,15 +48,48 @@ import pwd
 import time
 import pty
 import errno
+import socket
+import select
+import threading
 import subprocess
 import multiprocessing
 import json
-
+import zlib
+import struct
+import bisect
+import operator
+import locale
+import resource
+import cProfile
+import pstats
+
+from array import array
 from collections import defaultdict
 from collections import namedtuple
+from collections import OrderedDict
 
 from optparse import OptionParser
 
+try:
+    import ctypes, ctypes.util
+except ImportError:
+    ctypes = None
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
 
 try:
     import curses, _curses
@@ -55,8 +108,16 @@ HAS_DOCKER = cmd_exists('docker')
 HAS_OPENVZ = cmd_exists('vzctl')
 regexp_ovz_container = re.compile('^/\d+$')
 HAS_LIBVIRT = cmd_exists('virsh')
+regexp_docker_id = re.compile('^[0-9a-f]{64}$')
 
 
+# Clock for durations, immune to system time changes when available
+monotonic = getattr(time, 'monotonic', time.time)
+
+# From Python 3.12, cProfile uses sys.monitoring: a single profiler sees all
+# threads, and enabling a second one raises ValueError
+PROFILE_ALL_THREADS = sys.version_info >= (3, 12)
+
 HIDE_EMPTY_CGROUP = True
 CGROUP_MOUNTPOINTS={}
 CONFIGURATION = {
@@ -72,8 +133,20 @@ CONFIGURATION = {
         'selected_line_num': 0,
         'selected_line_name': '/',
         'cgroups': [],
+        'cgroups_index': {},
+        'list_height': 1,
+        'search': None,
+        'last_search': '',
+        'drilldown': None,
+        'remote': False,
+        'show_timings': False,
+        'drilldown_offset': 0,
         'fold': [],
         'type': [],
+        'history': 60,
+        'replay': None,
+        'replay_speed': 1.0,
+        'replay_seek': 0,
 }
 
 Column = namedtuple('Column', ['title', 'width', 'align', 'col_fmt', 'col_data', 'col_sort'])
@@ -81,18 +154,40 @@ Column = namedtuple('Column', ['title', 'width', 'align', 'col_fmt', 'col_data',
 COLUMNS = []
 COLUMNS_MANDATORY = ['name']
 COLUMNS_AVAILABLE = {
+    'host':      Column("HOST",    16, '<', '{0:%ss}',      'host',            'host'),
     'owner':     Column("OWNER",   10, '<', '{0:%ss}',      'owner',           'owner'),
     'type':      Column("TYPE",    10, '<', '{0:%ss}',      'type',            'type'),
-    'processes': Column("PROC",    11, '>', '{0:%ss}',      'tasks',           'tasks'),
+    'image':     Column("IMAGE",   20, '<', '{0:%ss}',      'image',           'image'),
+    'processes': Column("PROC",    11, '>', '{0:%ss}',      'tasks',           'cur_tasks'),
     'memory':    Column("MEMORY",  17, '^', '{0:%ss}',      'memory_cur_str',  'memory_cur_bytes'),
     'cpu-sys':   Column("SYST",     5, '^', '{0: >%s.1%%}', 'cpu_syst',        'cpu_total'),
     'cpu-user':  Column("USER",     5, '^', '{0: >%s.1%%}', 'cpu_user',        'cpu_total'),
     'blkio':     Column("BLKIO",   10, '^', '{0: >%s}',     'blkio_bw',        'blkio_bw_bytes'),
     'cpu-time':  Column("TIME+",   14, '^', '{0: >%ss}',    'cpu_total_str',   'cpu_total_seconds'),
+    'cpu-graph':       Column("CPU HISTORY",     20, '<', '{0:%ss}',      'cpu_spark',       'cpu_avg'),
+    'cpu-min':         Column("CPUMIN",           6, '^', '{0: >%s.1%%}', 'cpu_min',         'cpu_min'),
+    'cpu-avg':         Column("CPUAVG",           6, '^', '{0: >%s.1%%}', 'cpu_avg',         'cpu_avg'),
+    'cpu-p95':         Column("CPUP95",           6, '^', '{0: >%s.1%%}', 'cpu_p95',         'cpu_p95'),
+    'memory-graph':    Column("MEMORY HISTORY",  20, '<', '{0:%ss}',      'memory_spark',    'memory_avg'),
+    'memory-min':      Column("MEMMIN",           8, '>', '{0: >%ss}',    'memory_min_str',  'memory_min'),
+    'memory-avg':      Column("MEMAVG",           8, '>', '{0: >%ss}',    'memory_avg_str',  'memory_avg'),
+    'memory-p95':      Column("MEMP95",           8, '>', '{0: >%ss}',    'memory_p95_str',  'memory_p95'),
+    'blkio-graph':     Column("BLKIO HISTORY",   20, '<', '{0:%ss}',      'blkio_spark',     'blkio_avg'),
+    'blkio-p95':       Column("BLKIOP95",        10, '>', '{0: >%ss}',    'blkio_p95_str',   'blkio_p95'),
+    'processes-graph': Column("PROC HISTORY",    20, '<', '{0:%ss}',      'tasks_spark',     'tasks_avg'),
+    'cpu-psi':         Column("CPUPSI",           6, '^', '{0: >%s.1%%}', 'cpu_pressure',    'cpu_pressure'),
+    'memory-psi':      Column("MEMPSI",           6, '^', '{0: >%s.1%%}', 'memory_pressure', 'memory_pressure'),
+    'io-psi':          Column("IOPSI",            6, '^', '{0: >%s.1%%}', 'io_pressure',     'io_pressure'),
+    'throttled':       Column("THROTTLED",        9, '>', '{0: >%s}',     'nr_throttled',    'nr_throttled'),
+    'throttled-time':  Column("THRTIME",          7, '^', '{0: >%s.1%%}', 'throttled',       'throttled'),
     'name':      Column("CGROUP",  '', '<', '{0:%ss}',      'cgroup',          'cgroup'),
 }
 
+# Maximum delay, in ms, before a key press or a new snapshot is handled
+INPUT_TIMEOUT = 50
+
 DOCKER_PREFIXES = ["/docker/", "/system.slice/docker-", "/system.slice/docker/"]
+DOCKER_SOCKET = '/var/run/docker.sock'
 
 # TODO:
 # - visual CPU/memory usage
@@ -111,51 +206,215 @@ def strip_prefix(prefix, text):
     return text
 
 
-def docker_container_name(container_id, default, cache=dict()):
-    # Python's default arguments are evaluated when the function is
-    # defined, not when the function is called.
-    # We potentially cache and return a default value so we don't spend time
-    # pointlessly retrying to get the container name if something goes wrong.
-    cached_name = cache.get(container_id)
-    if cached_name:
-        return cached_name
+def docker_socket_path():
+    '''
+    Get Docker Engine API unix socket path, honoring 'DOCKER_HOST'
+    '''
+    host = os.environ.get('DOCKER_HOST', '')
+    if host.startswith('unix://'):
+        return host[len('unix://'):]
+    return DOCKER_SOCKET
 
+def docker_api_get(path, timeout=None):
+    '''
+    GET ``path`` from the Docker Engine API and return a file object on the
+    response body. HTTP/1.0 is used on purpose so that the daemon sends the
+    body as-is (no chunked encoding) and closes the connection when done,
+    which also works for streams like '/events'.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
     try:
-        sp = subprocess.Popen(['docker', 'inspect', container_id],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
-    except OSError:
-        # `docker` is not on PATH
-        cache[container_id] = default
-        return default
+        sock.connect(docker_socket_path())
+        sock.sendall(('GET %s HTTP/1.0\r\nHost: docker\r\n\r\n' % path).encode('ascii'))
+        body = sock.makefile('rb')
+    finally:
+        # The file object holds its own reference on the socket
+        sock.close()
 
-    for _ in range(10):
-        sp.poll()
-        if sp.returncode is not None:
-            break
-        time.sleep(0.1)
+    status = body.readline().split()
+    if len(status) < 2 or status[1] != b'200':
+        body.close()
+        raise IOError(errno.EIO, "Docker API error on %s: %s" % (path, b' '.join(status[1:]).decode('utf-8', 'replace')))
+
+    # Skip headers
+    while body.readline().strip():
+        pass
 
-    if sp.returncode is None:
+    return body
+
+class DockerImageTags(object):
+    '''
+    Image ID -> repository tags, from one '/images/json' request instead of
+    one image inspect per container. Image events mark it stale, it is then
+    loaded again on next lookup, at most every ``MIN_REFRESH_INTERVAL``
+    seconds.
+    '''
+    MIN_REFRESH_INTERVAL = 5
+
+    def __init__(self):
+        self.tags = {}
+        self.stale = True
+        self.last_refresh = 0
+
+    def refresh(self):
+        self.last_refresh = time.time()
         try:
-            sp.kill()
-        except OSError:
-            # OSError: [Errno 3] No such process
-            pass
-    elif sp.returncode == 0:
-        stdout, _stderr = sp.communicate()
+            body = docker_api_get('/images/json', timeout=1)
+            try:
+                images = json.loads(body.read().decode('utf-8'))
+            finally:
+                body.close()
+        except (IOError, OSError, ValueError):
+            return False
+
+        self.tags = dict((image['Id'], [tag for tag in image.get('RepoTags') or [] if tag != '<none>:<none>'])
+                         for image in images)
+        self.stale = False
+        return True
+
+    def invalidate(self):
+        self.stale = True
+
+    def name(self, image):
+        '''
+        First tag of ``image``, when it is an image ID. References, like
+        'nginx:latest' in container events, are returned as-is.
+        '''
+        if not image.startswith('sha256:'):
+            return image
+        if self.stale and time.time() - self.last_refresh >= self.MIN_REFRESH_INTERVAL:
+            self.refresh()
+        tags = self.tags.get(image)
+        return tags[0] if tags else image[len('sha256:'):][:12]
+
+DOCKER_IMAGES = DockerImageTags()
+
+class DockerNameResolver(object):
+    '''
+    Resolve Docker container IDs to names and images with the Engine API.
+    All containers are listed in one request, then names are kept current
+    from the '/events' stream. Entries expire after ``TTL`` seconds so that
+    renamed or removed containers are eventually picked up even if an event
+    was lost. Image events invalidate ``DOCKER_IMAGES``.
+    '''
+    TTL = 60
+    MAX_ENTRIES = 4096
+    MIN_REFRESH_INTERVAL = 5
+    EVENTS_PATH = '/events?filters=%7B%22type%22%3A%5B%22container%22%2C%22image%22%5D%7D' # {"type":["container","image"]}
+
+    def __init__(self):
+        self.names = OrderedDict() # id -> (name, image, expiration)
+        self.lock = threading.Lock()
+        self.last_refresh = 0
+        self.events_thread = None
+
+    def _store(self, container_id, name, image=None):
+        with self.lock:
+            previous = self.names.pop(container_id, None)
+            if image is None and previous is not None:
+                image = previous[1]
+            self.names[container_id] = ('/docker/' + name.lstrip('/'), image or '', time.time() + self.TTL)
+            while len(self.names) > self.MAX_ENTRIES:
+                self.names.popitem(last=False)
+
+    def _forget(self, container_id):
+        with self.lock:
+            self.names.pop(container_id, None)
+
+    def refresh(self):
+        '''
+        Bulk load the names of all containers. Return True on success.
+        '''
+        self.last_refresh = time.time()
         try:
-            containers = json.loads(stdout)
-            if len(containers) == 1:
-                container = containers[0]
-                container_name = container['Name'].lstrip('/')
-                name = '/docker/' + container_name
-                cache[container_id] = name
-                return name
-        except Exception:
+            body = docker_api_get('/containers/json?all=1', timeout=1)
+            try:
+                containers = json.loads(body.read().decode('utf-8'))
+            finally:
+                body.close()
+        except (IOError, OSError, ValueError):
+            # Docker is not running or not reachable
+            return False
+
+        with self.lock:
+            self.names.clear()
+        for container in containers[:self.MAX_ENTRIES]:
+            if container.get('Names'):
+                self._store(container['Id'], container['Names'][0], container.get('ImageID'))
+
+        # Keep up to date from events
+        if self.events_thread is None or not self.events_thread.is_alive():
+            self.events_thread = threading.Thread(target=self.listen_events)
+            self.events_thread.daemon = True
+            self.events_thread.start()
+
+        return True
+
+    def listen_events(self):
+        '''
+        Apply container events until the stream breaks. Next refresh restarts it.
+        '''
+        try:
+            body = docker_api_get(self.EVENTS_PATH)
+            try:
+                for line in iter(body.readline, b''):
+                    try:
+                        event = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        continue
+
+                    if event.get('Type') == 'image':
+                        DOCKER_IMAGES.invalidate()
+                        continue
+
+                    action = event.get('Action') or event.get('status', '')
+                    actor = event.get('Actor', {})
+                    container_id = actor.get('ID') or event.get('id')
+                    name = actor.get('Attributes', {}).get('name')
+                    image = actor.get('Attributes', {}).get('image')
+
+                    if action == 'destroy':
+                        self._forget(container_id)
+                    elif action in ('create', 'start', 'rename') and container_id and name:
+                        self._store(container_id, name, image)
+            finally:
+                body.close()
+        except (IOError, OSError):
             pass
 
-    cache[container_id] = default
-    return default
+    def _lookup(self, container_id):
+        entry = self.names.get(container_id)
+        if entry is None or entry[2] < time.time():
+            # Unknown or stale: reload all names, but not too often
+            if time.time() - self.last_refresh >= self.MIN_REFRESH_INTERVAL:
+                self.refresh()
+                entry = self.names.get(container_id)
+        return entry
+
+    def resolve(self, container_id, default):
+        entry = self._lookup(container_id)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def image(self, container_id):
+        '''
+        First tag of the container's image, or its short ID
+        '''
+        entry = self._lookup(container_id)
+        if entry is None or not entry[1]:
+            return ''
+        return DOCKER_IMAGES.name(entry[1])
+
+DOCKER_NAMES = DockerNameResolver()
+
+def docker_container_name(container_id, default):
+    # Docker container IDs are 64 hexadecimal chars. Anything else, like
+    # nested cgroups, is not a container and keeps its path.
+    if not regexp_docker_id.match(container_id):
+        return default
+    return DOCKER_NAMES.resolve(container_id, default)
 
 def libvirt_vm_name(cgroup_line):
     # Get VM name from cgroup line like
@@ -242,6 +501,7 @@ def run(user, cmd, interactive=False):
         # Restore screen
         init_screen()
         curses.resetty()
+        FRAME.invalidate()
     else:
         with open('/dev/null', 'w') as dev_null:
             subprocess.Popen(
@@ -251,7 +511,117 @@ def run(user, cmd, interactive=False):
                 close_fds=True,
             )
 
+# Descriptor limit to raise the soft limit to, when the hard limit allows
+MAX_OPEN_FILES = 65536
+
+def stat_file_budget():
+    '''
+    Maximum number of stat files to keep open: half the soft descriptor limit
+    so that there is room left for everything else. The soft limit is first
+    raised towards the hard one, as it is often much lower (1024).
+    '''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY:
+        wanted = MAX_OPEN_FILES if hard == resource.RLIM_INFINITY else min(hard, MAX_OPEN_FILES)
+        if wanted > soft:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+                soft = wanted
+            except (ValueError, resource.error):
+                pass
+
+    if soft == resource.RLIM_INFINITY:
+        return 4096
+    return max(64, soft // 2)
+
+class StatFileCache(object):
+    '''
+    Long lived cache of open stat files. Files are re-read from offset 0 with
+    a single ``pread`` instead of open/read/close on each refresh. Once the
+    budget is used, further files are read uncached: files are read in the
+    same order on each refresh, so evicting the least recently used one would
+    miss on every read. Files of removed cgroups free their slot.
+    '''
+    READ_SIZE = 65536
+
+    def __init__(self, max_fds):
+        self.max_fds = max_fds
+        self.fds = {}
+        self.by_dir = defaultdict(set)
+
+    def _pread(self, fd, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(fd, self.READ_SIZE, offset)
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, self.READ_SIZE)
+
+    def _read_all(self, fd):
+        chunks = [self._pread(fd, 0)]
+        while len(chunks[-1]) == self.READ_SIZE:
+            chunks.append(self._pread(fd, len(chunks) * self.READ_SIZE))
+        return b''.join(chunks)
+
+    def read(self, path):
+        '''
+        Return the full content of ``path``. Raise IOError(ENOENT) if the file,
+        or its cgroup, is gone.
+        '''
+        try:
+            fd = self.fds.get(path)
+            if fd is not None:
+                content = self._read_all(fd)
+            elif len(self.fds) < self.max_fds:
+                fd = os.open(path, os.O_RDONLY)
+                self.fds[path] = fd
+                self.by_dir[os.path.dirname(path)].add(path)
+                content = self._read_all(fd)
+            else:
+                # Budget used: plain open/read/close
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    content = self._read_all(fd)
+                finally:
+                    os.close(fd)
+        except (IOError, OSError) as e:
+            self.close(path)
+            if e.errno in (errno.ENOENT, errno.ENODEV):
+                # Removed cgroup: report it like a missing file
+                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            raise IOError(e.errno, e.strerror, path)
+
+        if not isinstance(content, str):
+            content = content.decode('utf-8', 'replace')
+        return content
+
+    def close(self, path):
+        fd = self.fds.pop(path, None)
+        if fd is None:
+            return
+
+        dirname = os.path.dirname(path)
+        self.by_dir[dirname].discard(path)
+        if not self.by_dir[dirname]:
+            del self.by_dir[dirname]
+
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+    def retain(self, dirs):
+        '''
+        Close the files of any cgroup directory not in ``dirs``
+        '''
+        for dirname in [d for d in self.by_dir if d not in dirs]:
+            for path in list(self.by_dir.get(dirname, ())):
+                self.close(path)
+
+STAT_FILES = StatFileCache(stat_file_budget())
+
 class Cgroup(object):
+    # File listing the tasks attached to this cgroup
+    tasks_file = 'tasks'
+
     def __init__(self, path, base_path):
         self.path = path
         self.base_path = base_path
@@ -260,19 +630,31 @@ class Cgroup(object):
     def short_path(self):
         return self.path[len(self.base_path):] or '/'
 
+    @property
+    def container_id(self):
+        container_id = self.short_path
+        for prefix in DOCKER_PREFIXES:
+            container_id = strip_prefix(prefix, container_id)
+        if container_id.endswith('.scope'):
+            container_id = container_id[:-len('.scope')]
+        return container_id
+
     @property
     def name(self):
         if HAS_DOCKER and self.type == 'docker':
-            container_id = self.short_path
-            for prefix in DOCKER_PREFIXES:
-                container_id = strip_prefix(prefix, container_id)
-            return docker_container_name(container_id, default=self.short_path)
+            return docker_container_name(self.container_id, default=self.short_path)
 
         return self.short_path
 
+    @property
+    def image(self):
+        if HAS_DOCKER and self.type == 'docker' and regexp_docker_id.match(self.container_id):
+            return DOCKER_NAMES.image(self.container_id)
+        return ''
+
     @property
     def owner(self):
-        path = os.path.join(self.base_path, self.path, 'tasks')
+        path = os.path.join(self.base_path, self.path, self.tasks_file)
         uid = os.stat(path).st_uid
         try:
             return pwd.getpwuid(uid).pw_name
@@ -318,15 +700,13 @@ class Cgroup(object):
 
     def __getitem__(self, name):
         path = os.path.join(self.base_path, self.path, name)
+        content = STAT_FILES.read(path).strip()
 
-        with open(path) as f:
-            content = f.read().strip()
-
-        if name == 'tasks' or '\n' in content or ' ' in content:
+        if name in (self.tasks_file, 'cgroup.procs') or '\n' in content or ' ' in content:
             content = content.split('\n')
 
             if ' ' in content[0]:
-                content = dict((re.split(' +', l, 1) for l in content if content))
+                content = dict((l.split(None, 1) for l in content if content))
                 for k, v in content.items():
                     content[k] = self._coerce(v)
             else:
@@ -337,32 +717,220 @@ class Cgroup(object):
 
         return content
 
-def cgroups(base_path):
+class CgroupV2(Cgroup):
+    '''
+    Cgroup of the unified (v2) hierarchy. There is no 'tasks' file on v2,
+    processes are listed in 'cgroup.procs'.
+    '''
+    tasks_file = 'cgroup.procs'
+
+def cgroups(base_path, cls=Cgroup):
     '''
     Generator of cgroups under path ``name``
     '''
     for cgroup_path, dirs, files in os.walk(base_path):
-        yield Cgroup(cgroup_path, base_path)
+        yield cls(cgroup_path, base_path)
+
+class Inotify(object):
+    '''
+    Minimal inotify binding, through ctypes. Only what is needed to track
+    directory creation / removal.
+    '''
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ONLYDIR     = 0x01000000
+    IN_ISDIR       = 0x40000000
+    IN_CLOEXEC     = 0x00080000
+    IN_NONBLOCK    = 0x00000800
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        if ctypes is None:
+            raise OSError(errno.ENOSYS, "ctypes is not available")
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return wd
+
+    def read_events(self):
+        '''
+        Return all pending events as a list of (wd, mask, name). Never blocks.
+        '''
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _cookie, length = self.EVENT.unpack_from(buf, offset)
+                offset += self.EVENT.size
+                name = buf[offset:offset+length].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+class CgroupTree(object):
+    '''
+    Cached list of the cgroups of one hierarchy. It is built with a full walk,
+    then kept current from inotify directory events so that a refresh costs
+    O(changes) instead of O(cgroups). A full walk still runs every
+    ``RESYNC_INTERVAL`` seconds as a safety net, and on every refresh if
+    inotify is not usable.
+    '''
+    RESYNC_INTERVAL = 60
+    WATCH_MASK = Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM | \
+                 Inotify.IN_MOVED_TO | Inotify.IN_ONLYDIR
+
+    def __init__(self, base_path, cls=Cgroup):
+        self.base_path = base_path
+        self.cls = cls
+        self.cgroups = OrderedDict() # path -> Cgroup
+        self.children = defaultdict(set)
+        self.watches = {}            # wd -> path
+        self.last_resync = 0
+
+        try:
+            self.inotify = Inotify()
+        except OSError:
+            self.inotify = None
+
+    def refresh(self):
+        '''
+        Bring the tree up to date and return the list of its cgroups
+        '''
+        if self.inotify is None or time.time() - self.last_resync > self.RESYNC_INTERVAL:
+            self.resync()
+        else:
+            self.apply_events()
+        return list(self.cgroups.values())
+
+    def _watch(self, path):
+        if self.inotify is None:
+            return
+        try:
+            self.watches[self.inotify.add_watch(path, self.WATCH_MASK)] = path
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                # Already gone, will be handled by the delete event
+                return
+            # Most likely out of watches (ENOSPC): fallback on full walks
+            self.inotify.close()
+            self.inotify = None
+            self.watches.clear()
+
+    def _add(self, path):
+        '''
+        Add cgroup ``path`` and all its descendants
+        '''
+        for cgroup in cgroups(path, self.cls):
+            # Watch before listing the children so none can be missed
+            self._watch(cgroup.path)
+            cgroup.base_path = self.base_path
+            if cgroup.path not in self.cgroups:
+                self.cgroups[cgroup.path] = cgroup
+                self.children[os.path.dirname(cgroup.path)].add(cgroup.path)
+
+    def _remove(self, path):
+        '''
+        Remove cgroup ``path`` and all its descendants
+        '''
+        self.children[os.path.dirname(path)].discard(path)
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            self.cgroups.pop(path, None)
+            stack.extend(self.children.pop(path, ()))
+
+    def resync(self):
+        self.cgroups.clear()
+        self.children.clear()
+        self.watches.clear()
+        self._add(self.base_path)
+        self.last_resync = time.time()
+
+        # Events received so far are covered by the walk
+        if self.inotify is not None:
+            self.inotify.read_events()
+
+    def apply_events(self):
+        for wd, mask, name in self.inotify.read_events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                # Some events were lost
+                self.resync()
+                return
+
+            if mask & Inotify.IN_IGNORED:
+                # Watched directory was removed
+                self.watches.pop(wd, None)
+                continue
+
+            parent = self.watches.get(wd)
+            if parent is None or not mask & Inotify.IN_ISDIR:
+                continue
+
+            path = os.path.join(parent, name)
+            if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                self._add(path)
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                self._remove(path)
+
+# Mountpoint -> CgroupTree
+CGROUP_TREES = {}
 
 ## Grab cgroup data
 
 def init():
     # Get all cgroup subsystems avalaible on this system
-    with open("/proc/cgroups") as f:
-        cgroups = f.read().strip()
+    try:
+        with open("/proc/cgroups") as f:
+            cgroups = f.read().strip()
+    except IOError:
+        # Recent kernels may not expose it on cgroup2-only systems
+        cgroups = ''
 
     subsystems = []
     for cgroup in cgroups.split('\n'):
-        if cgroup[0] == '#': continue
+        if not cgroup or cgroup[0] == '#': continue
         subsystems.append(cgroup.split()[0])
 
     # Match cgroup mountpoints to susbsytems. Always take the first matching
     with open("/proc/mounts") as f:
         mounts = f.read().strip()
 
+    unified = None
     for mount in mounts.split('\n'):
         mount = mount.split(' ')
 
+        if mount[2] == "cgroup2":
+            unified = unified or mount[1]
+            continue
+
         if mount[2] != "cgroup":
             continue
 
@@ -370,6 +938,11 @@ def init():
             if arg in subsystems and arg not in CGROUP_MOUNTPOINTS:
                 CGROUP_MOUNTPOINTS[arg] = mount[1]
 
+    # On hybrid systems, the unified hierarchy holds no controller: prefer v1.
+    # Use the unified hierarchy only if this is a cgroup2-only system.
+    if unified and not CGROUP_MOUNTPOINTS:
+        CGROUP_MOUNTPOINTS['unified'] = unified
+
 def collect_ensure_common(data, cgroup):
     '''
     Some cgroup exists in only one controller. Attempt to collect common metrics
@@ -379,9 +952,33 @@ def collect_ensure_common(data, cgroup):
         return
 
     # Collect
-    data['tasks'] = cgroup['tasks']
-    data['owner'] = cgroup.owner
-    data['type'] = cgroup.type
+    data['tasks'] = cgroup[cgroup.tasks_file]
+    data['owner'], data['type'], data['image'] = METADATA.get(cgroup)
+
+class MetadataCache(object):
+    '''
+    Owner, type and image of each cgroup. They need extra system calls
+    (stat, pwd, isdir) or API requests and hardly ever change: they are only
+    looked up again once the cache is cleared, every 'owner' sampling
+    interval. ``cost`` accumulates the time spent on lookups.
+    '''
+    def __init__(self):
+        self.entries = {}
+        self.cost = 0
+
+    def get(self, cgroup):
+        entry = self.entries.get(cgroup.path)
+        if entry is None:
+            start = monotonic()
+            entry = self.entries[cgroup.path] = (cgroup.owner, cgroup.type, cgroup.image)
+            self.cost += monotonic() - start
+        return entry
+
+    def clear(self):
+        self.entries = {}
+        self.cost = 0
+
+METADATA = MetadataCache()
 
 def get_user_beacounts():
     '''
@@ -396,92 +993,480 @@ def get_user_beacounts():
     return output
 
 
-def collect(measures):
-    cur = defaultdict(dict)
-    prev = measures['data']
+def read_optional(cgroup, name):
+    '''
+    Read stat file ``name`` from ``cgroup``. Return None if it does not exist,
+    typically because the controller is not enabled for this cgroup.
+    '''
+    try:
+        return cgroup[name]
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+def collect_counters(data, prev_data, key, values):
+    '''
+    Store counters ``values`` under ``key`` and their increase since the
+    previous refresh under ``key + '.diff'``, like 'cpuacct.stat.diff'
+    '''
+    data[key] = values
+    data[key + '.diff'] = dict((k, 0) for k in values)
+    if key in prev_data:
+        for k, value in values.items():
+            data[key + '.diff'][k] = value - prev_data[key].get(k, value)
+
+def parse_pressure(content):
+    '''
+    Parse a PSI file into {'some': total_usec, 'full': total_usec}. Lines are
+    like 'some avg10=0.00 avg60=0.00 avg300=0.00 total=1234'
+    '''
+    totals = {}
+    if isinstance(content, dict):
+        for kind, fields in content.items():
+            for field in str(fields).split():
+                key, _, value = field.partition('=')
+                if key == 'total':
+                    totals[kind] = int(value)
+    return totals
+
+# Cleared once the kernel refuses PSI reads: built in but disabled (psi=0)
+PRESSURE_SUPPORT = {'enabled': True}
+
+def collect_pressure(data, prev_data, cgroup, resources=('cpu', 'memory', 'io')):
+    '''
+    Collect Pressure Stall Information. Only available on the unified
+    hierarchy, and not for the root cgroup (see /proc/pressure).
+    '''
+    for resource_name in resources:
+        if not PRESSURE_SUPPORT['enabled']:
+            return
+        try:
+            content = read_optional(cgroup, resource_name + '.pressure')
+        except IOError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+            PRESSURE_SUPPORT['enabled'] = False
+            return
+        totals = parse_pressure(content)
+        if totals:
+            collect_counters(data, prev_data, resource_name + '.pressure', totals)
+
+def discover():
+    '''
+    List the cgroups of all the hierarchies we collect from. Each hierarchy is
+    refreshed once per tick, even when several controllers are mounted
+    together.
+
+    Return a dict of mountpoint -> [cgroup, ...]
+    '''
+    hierarchies = {}
+    for controller, _collector in COLLECTORS:
+        if controller not in CGROUP_MOUNTPOINTS:
+            continue
+
+        mountpoint = CGROUP_MOUNTPOINTS[controller]
+        if mountpoint in hierarchies:
+            continue
+
+        if mountpoint not in CGROUP_TREES:
+            cls = CgroupV2 if controller == 'unified' else Cgroup
+            CGROUP_TREES[mountpoint] = CgroupTree(mountpoint, cls)
+
+        hierarchies[mountpoint] = CGROUP_TREES[mountpoint].refresh()
 
+    return hierarchies
 
-    # Collect CPU statistics
-    if 'cpuacct' in CGROUP_MOUNTPOINTS:
-        # list all "folders" under mountpoint
-        for cgroup in cgroups(CGROUP_MOUNTPOINTS['cpuacct']):
-            collect_ensure_common(cur[cgroup.name], cgroup)
+def resolve_names(hierarchies):
+    '''
+    Name the cgroups found by ``discover()``. Each name is resolved once, even
+    when the cgroup exists in several hierarchies.
 
-            # Collect CPU stats
-            cur[cgroup.name]['cpuacct.stat'] = cgroup['cpuacct.stat']
-            cur[cgroup.name]['cpuacct.stat.diff'] = {'user':0, 'system':0}
+    Return a dict of mountpoint -> [(name, cgroup), ...]
+    '''
+    names = {}
+    named = {}
+    for mountpoint, cgroups in hierarchies.items():
+        listed = []
+        for cgroup in cgroups:
+            short_path = cgroup.short_path
+            if short_path not in names:
+                names[short_path] = cgroup.name
+            listed.append((names[short_path], cgroup))
+        named[mountpoint] = listed
+    return named
+
+def list_processes(hierarchies, name):
+    '''
+    PIDs of the processes in cgroup ``name``. On v1, 'tasks' lists every
+    thread while 'cgroup.procs' only lists thread group leaders, whose /proc
+    files account for the whole process.
+    '''
+    for listed in hierarchies.values():
+        for cgroup_name, cgroup in listed:
+            if cgroup_name == name:
+                return read_optional(cgroup, 'cgroup.procs')
+    return None
 
-            # Collect CPU increase on run > 1
-            if cgroup.name in prev:
-                for key, value in cur[cgroup.name]['cpuacct.stat'].items():
-                    cur[cgroup.name]['cpuacct.stat.diff'][key] = value - prev[cgroup.name]['cpuacct.stat'][key]
+def collect_unified(cur, prev, measures, listed):
+    '''
+    Collect all statistics from the unified (v2) hierarchy. Controller files
+    are mapped to their v1 equivalent so that the rest of the code does not
+    need to care about the cgroup version.
+    '''
+    usec_to_ticks = measures['global']['scheduler_frequency'] / 1000000.0
+    due = measures['due']
+
+    for name, cgroup in listed:
+        data = cur[name]
+        collect_ensure_common(data, cgroup)
+
+        # Collect CPU stats. Always available, in micro-seconds
+        cpu_stat = read_optional(cgroup, 'cpu.stat') if 'cpu' in due else None
+        if isinstance(cpu_stat, dict):
+            data['cpuacct.stat'] = {
+                'user': cpu_stat.get('user_usec', 0) * usec_to_ticks,
+                'system': cpu_stat.get('system_usec', 0) * usec_to_ticks,
+            }
+            data['cpuacct.stat.diff'] = {'user':0, 'system':0}
+            if 'cpuacct.stat' in prev.get(name, {}):
+                for key, value in data['cpuacct.stat'].items():
+                    data['cpuacct.stat.diff'][key] = value - prev[name]['cpuacct.stat'][key]
+
+            # CPU bandwidth throttling. Only with the cpu controller enabled
+            if 'nr_throttled' in cpu_stat:
+                collect_counters(data, prev.get(name, {}), 'cpu.throttling', {
+                    'nr_throttled': cpu_stat['nr_throttled'],
+                    'throttled_usec': cpu_stat.get('throttled_usec', 0),
+                })
+
+        # Collect contention
+        collect_pressure(data, prev.get(name, {}), cgroup, [PRESSURE_RESOURCES[metric] for metric in due if metric in PRESSURE_RESOURCES])
+
+        # Collect BlockIO stats. Lines like '8:0 rbytes=1 wbytes=2 rios=3 ...'
+        io_stat = read_optional(cgroup, 'io.stat') if 'blkio' in due else None
+        if io_stat is not None:
+            total = 0
+            if isinstance(io_stat, dict):
+                for fields in io_stat.values():
+                    for field in str(fields).split():
+                        key, _, value = field.partition('=')
+                        if key in ('rbytes', 'wbytes'):
+                            total += int(value)
+            data['blkio.throttle.io_service_bytes'] = {'Total': total}
+            data['blkio.throttle.io_service_bytes.diff'] = {'total':0}
+            if 'blkio.throttle.io_service_bytes' in prev.get(name, {}):
+                prev_val = prev[name]['blkio.throttle.io_service_bytes']['Total']
+                data['blkio.throttle.io_service_bytes.diff']['total'] = total - prev_val
+
+        # Collect memory stats. Root cgroup does *not* have 'memory.current'
+        memory_current = read_optional(cgroup, 'memory.current') if 'memory' in due else None
+        if memory_current is not None:
+            memory_stat = read_optional(cgroup, 'memory.stat') or {}
+            data['memory.usage_in_bytes'] = memory_current - memory_stat.get('file', 0)
+            memory_max = read_optional(cgroup, 'memory.max')
+            if not isinstance(memory_max, int):
+                memory_max = measures['global']['total_memory']
+            data['memory.limit_in_bytes'] = min(memory_max, measures['global']['total_memory'])
+
+        # Collect PIDs constraints. Root cgroup does *not* have the controller files
+        pids_max = read_optional(cgroup, 'pids.max') if 'pids' in due and name != "/" else None
+        if pids_max is not None:
+            data['pids.max'] = pids_max
+
+def collect_cpuacct(cur, prev, measures, listed):
+    for name, cgroup in listed:
+        collect_ensure_common(cur[name], cgroup)
+
+        # Collect CPU stats
+        cur[name]['cpuacct.stat'] = cgroup['cpuacct.stat']
+        cur[name]['cpuacct.stat.diff'] = {'user':0, 'system':0}
+
+        # Collect CPU increase on run > 1
+        if name in prev:
+            for key, value in cur[name]['cpuacct.stat'].items():
+                cur[name]['cpuacct.stat.diff'][key] = value - prev[name]['cpuacct.stat'][key]
+
+def collect_cpu(cur, prev, measures, listed):
+    for name, cgroup in listed:
+        collect_ensure_common(cur[name], cgroup)
+
+        # Collect CPU bandwidth throttling. Time is in nano-seconds on v1
+        cpu_stat = read_optional(cgroup, 'cpu.stat')
+        if isinstance(cpu_stat, dict) and 'nr_throttled' in cpu_stat:
+            collect_counters(cur[name], prev.get(name, {}), 'cpu.throttling', {
+                'nr_throttled': cpu_stat['nr_throttled'],
+                'throttled_usec': cpu_stat.get('throttled_time', 0) // 1000,
+            })
+
+def collect_blkio(cur, prev, measures, listed):
+    for name, cgroup in listed:
+        collect_ensure_common(cur[name], cgroup)
+
+        # Collect BlockIO stats
+        try:
+            cur[name]['blkio.throttle.io_service_bytes'] = cgroup['blkio.throttle.io_service_bytes']
+            cur[name]['blkio.throttle.io_service_bytes.diff'] = {'total':0}
+        except IOError as e:
+            # Workaround broken systems (see #15)
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+
+        # Collect BlockIO increase on run > 1
+        if name in prev:
+            cur_val = cur[name]['blkio.throttle.io_service_bytes']['Total']
+            prev_val = prev[name]['blkio.throttle.io_service_bytes']['Total']
+            cur[name]['blkio.throttle.io_service_bytes.diff']['total'] = cur_val - prev_val
+
+def collect_memory(cur, prev, measures, listed):
+    for name, cgroup in listed:
+        collect_ensure_common(cur[name], cgroup)
+        cache = cgroup['memory.stat']['cache']
+        cur[name]['memory.usage_in_bytes'] = cgroup['memory.usage_in_bytes'] - cache
+        cur[name]['memory.limit_in_bytes'] = min(int(cgroup['memory.limit_in_bytes']), measures['global']['total_memory'])
+
+def collect_pids(cur, prev, measures, listed):
+    # Root cgroup does *not* have the controller files
+    for name, cgroup in listed:
+        if name == "/":
+            continue
+        collect_ensure_common(cur[name], cgroup)
+        cur[name]['pids.max'] = cgroup['pids.max']
+
+# Controller -> collector, in collection order
+COLLECTORS = [
+    ('unified', collect_unified),
+    ('cpuacct', collect_cpuacct),
+    ('cpu',     collect_cpu),
+    ('blkio',   collect_blkio),
+    ('memory',  collect_memory),
+    ('pids',    collect_pids),
+]
+
+# v1 controller -> metric it samples. The unified collector samples all of them.
+CONTROLLER_METRICS = {
+    'cpuacct': 'cpu',
+    'cpu':     'cpu',
+    'blkio':   'blkio',
+    'memory':  'memory',
+    'pids':    'pids',
+}
 
-    # Collect BlockIO statistics
-    if 'blkio' in CGROUP_MOUNTPOINTS:
-        # list all "folders" under mountpoint
-        for cgroup in cgroups(CGROUP_MOUNTPOINTS['blkio']):
-            collect_ensure_common(cur[cgroup.name], cgroup)
+# Metric -> PSI resource
+PRESSURE_RESOURCES = {'cpu': 'cpu', 'memory': 'memory', 'blkio': 'io'}
 
-            # Collect BlockIO stats
+# Metric -> data keys it fills, kept from the previous pass when not sampled
+METRIC_KEYS = {
+    'cpu':    ['cpuacct.stat', 'cpuacct.stat.diff', 'cpu.throttling', 'cpu.throttling.diff', 'cpu.pressure', 'cpu.pressure.diff'],
+    'memory': ['memory.usage_in_bytes', 'memory.limit_in_bytes', 'memory.pressure', 'memory.pressure.diff'],
+    'blkio':  ['blkio.throttle.io_service_bytes', 'blkio.throttle.io_service_bytes.diff', 'io.pressure', 'io.pressure.diff'],
+    'pids':   ['pids.max'],
+}
+
+class SamplingSchedule(object):
+    '''
+    Sampling interval of each metric. Cheap counters can be read on every
+    pass while expensive lookups ('owner' for owner, type and image,
+    'openvz' for vzlist) wait for their own, longer, interval. ``due()`` tells which
+    metrics to sample on a pass, ``sampled()`` the actual time elapsed since
+    the previous sample of a metric, to compute its rates.
+
+    In adaptive mode, a metric whose sampling takes more than ``BUDGET`` of
+    its interval gets its interval doubled, up to ``MAX_STRETCH`` times. It
+    shrinks back once sampling is cheap again.
+    '''
+    METRICS = ('cpu', 'memory', 'blkio', 'pids', 'owner', 'openvz')
+    SLOW_METRICS = ('owner', 'openvz')
+    SLOW_INTERVAL = 10.0
+    BUDGET = 0.1
+    MAX_STRETCH = 16
+    # Tolerance on due time, so that timer jitter does not skip a pass
+    SLACK = 0.01
+
+    def __init__(self, default, intervals=None, adaptive=False):
+        self.configure(default, intervals, adaptive)
+
+    def configure(self, default, intervals=None, adaptive=False):
+        if default <= 0:
+            raise ValueError("refresh interval must be positive, got %r" % default)
+        self.refresh = default
+        self.intervals = {}
+        for metric in self.METRICS:
+            self.intervals[metric] = max(default, self.SLOW_INTERVAL) if metric in self.SLOW_METRICS else default
+        for metric, interval in (intervals or {}).items():
+            if metric not in self.intervals:
+                raise ValueError("unknown metric %r, expected one of %s" % (metric, ', '.join(self.METRICS)))
+            if interval <= 0:
+                raise ValueError("interval of %s must be positive, got %r" % (metric, interval))
+            self.intervals[metric] = interval
+        self.adaptive = adaptive
+        self.stretch = dict((metric, 1) for metric in self.METRICS)
+        self.last = {}
+        self.last_history = None
+
+    def interval(self, metric):
+        return self.intervals[metric] * self.stretch[metric]
+
+    def due(self, now):
+        return set(metric for metric in self.METRICS
+                   if metric not in self.last or now - self.last[metric] >= self.interval(metric) - self.SLACK)
+
+    def sampled(self, metric, now):
+        '''
+        Mark ``metric`` as sampled at ``now``. Return the time elapsed since
+        its previous sample, or None for the first one.
+        '''
+        prev = self.last.get(metric)
+        self.last[metric] = now
+        return now - prev if prev is not None else None
+
+    def account(self, metric, cost):
+        '''
+        Adapt ``metric`` interval to the ``cost`` of sampling it
+        '''
+        if not self.adaptive:
+            return
+        budget = self.BUDGET * self.interval(metric)
+        if cost > budget and self.stretch[metric] < self.MAX_STRETCH:
+            self.stretch[metric] *= 2
+        elif cost < budget / 4 and self.stretch[metric] > 1:
+            self.stretch[metric] //= 2
+
+    def next_delay(self, now):
+        '''
+        Delay until the next metric is due
+        '''
+        if not self.last:
+            return 0
+        return max(0, min(self.last.get(metric, now) + self.interval(metric) for metric in self.METRICS) - now)
+
+    def history_due(self, now):
+        '''
+        Tell whether to record history on this pass. History windows count
+        refreshes, not passes of the fastest metric.
+        '''
+        if self.last_history is not None and now - self.last_history < self.refresh - self.SLACK:
+            return False
+        self.last_history = now
+        return True
+
+    @staticmethod
+    def parse(text):
+        '''
+        Parse '<metric>=<seconds>,...'
+        '''
+        intervals = {}
+        for item in text.split(','):
+            if not item.strip():
+                continue
+            metric, _, seconds = item.partition('=')
             try:
-                cur[cgroup.name]['blkio.throttle.io_service_bytes'] = cgroup['blkio.throttle.io_service_bytes']
-                cur[cgroup.name]['blkio.throttle.io_service_bytes.diff'] = {'total':0}
-            except IOError as e:
-                # Workaround broken systems (see #15)
-                if e.errno == errno.ENOENT:
-                    continue
-                raise
+                intervals[metric.strip()] = float(seconds)
+            except ValueError:
+                raise ValueError("invalid interval %r for %s, expected <metric>=<seconds>" % (seconds, metric.strip()))
+        return intervals
 
-            # Collect BlockIO increase on run > 1
-            if cgroup.name in prev:
-                cur_val = cur[cgroup.name]['blkio.throttle.io_service_bytes']['Total']
-                prev_val = prev[cgroup.name]['blkio.throttle.io_service_bytes']['Total']
-                cur[cgroup.name]['blkio.throttle.io_service_bytes.diff']['total'] = cur_val - prev_val
-
-    # Collect memory statistics
-    if 'memory' in CGROUP_MOUNTPOINTS:
-        # list all "folders" under mountpoint
-        for cgroup in cgroups(CGROUP_MOUNTPOINTS['memory']):
-            collect_ensure_common(cur[cgroup.name], cgroup)
-            cache = cgroup['memory.stat']['cache']
-            cur[cgroup.name]['memory.usage_in_bytes'] = cgroup['memory.usage_in_bytes'] - cache
-            cur[cgroup.name]['memory.limit_in_bytes'] = min(int(cgroup['memory.limit_in_bytes']), measures['global']['total_memory'])
-
-    # Collect PIDs constraints. Root cgroup does *not* have the controller files
-    if 'pids' in CGROUP_MOUNTPOINTS:
-        # list all "folders" under mountpoint
-        for cgroup in cgroups(CGROUP_MOUNTPOINTS['pids']):
-            if cgroup.name == "/":
+SCHEDULE = SamplingSchedule(CONFIGURATION['refresh_interval'])
+
+def collect(measures):
+    cur = defaultdict(dict)
+    prev = measures['data']
+    timings = []
+
+    # Metrics to sample on this pass, and the time their rates will cover
+    now = time.time()
+    due = measures['due'] = SCHEDULE.due(now)
+    elapsed = measures.setdefault('elapsed', {})
+    for metric in due:
+        elapsed[metric] = SCHEDULE.sampled(metric, now)
+    if 'owner' in due:
+        METADATA.clear()
+
+    # Find all cgroups once, then read each controller against this list
+    start = monotonic()
+    hierarchies = discover()
+    STAT_FILES.retain(set(cgroup.path for cgroups in hierarchies.values() for cgroup in cgroups))
+    timings.append(('discover', monotonic() - start))
+
+    start = monotonic()
+    hierarchies = resolve_names(hierarchies)
+    timings.append(('name-resolve', monotonic() - start))
+
+    for controller, collector in COLLECTORS:
+        if controller not in CGROUP_MOUNTPOINTS:
+            continue
+        listed = hierarchies[CGROUP_MOUNTPOINTS[controller]]
+        metric = CONTROLLER_METRICS.get(controller)
+        start = monotonic()
+        if metric is None or metric in due:
+            collector(cur, prev, measures, listed)
+        else:
+            # Not due, still list this hierarchy's cgroups
+            for name, cgroup in listed:
+                collect_ensure_common(cur[name], cgroup)
+        duration = monotonic() - start
+        timings.append(('read:' + controller, duration))
+
+        # The unified collector samples all due metrics in one go
+        if metric is None:
+            sampled = [m for m in due if m in METRIC_KEYS]
+            for m in sampled:
+                SCHEDULE.account(m, duration / len(sampled))
+        elif metric in due:
+            SCHEDULE.account(metric, duration)
+
+    # Drill-down: processes of the selected cgroup, not its threads
+    drilldown = CONFIGURATION['drilldown']
+    measures['processes'] = list_processes(hierarchies, drilldown) if drilldown is not None else None
+
+    # Keep the last sample of the metrics not due on this pass
+    stale = [key for metric, keys in METRIC_KEYS.items() if metric not in due for key in keys]
+    if stale:
+        for name, data in cur.items():
+            old = prev.get(name)
+            if old is None:
                 continue
-            collect_ensure_common(cur[cgroup.name], cgroup)
-            cur[cgroup.name]['pids.max'] = cgroup['pids.max']
+            for key in stale:
+                if key in old and key not in data:
+                    data[key] = old[key]
 
     #Collect memory statistics for openvz
     if HAS_OPENVZ:
-        user_beancounters = get_user_beacounts()
-        # We have lines like -
-        #      1202     202419    2457600
-        #      1203     299835    2457600
-        #      1207      54684    2457600
-        #      1210     304939    2457600
-        #1000001212      13493    2457600
-        for line in user_beancounters.split('\n'):
-            if line == '':
-                continue
-            line = re.sub(r'^\s+', '', line)
-            splited_line = re.split('\s+', line)
-            if len(splited_line) != 3:
-                continue
-            ctid, privvmpages, limit = splited_line
-            ctid = '/' + ctid
-            if 'tasks' not in cur[ctid]:
+        start = monotonic()
+        if 'openvz' in due or 'openvz' not in measures:
+            measures['openvz'] = {}
+            user_beancounters = get_user_beacounts()
+            # We have lines like -
+            #      1202     202419    2457600
+            #      1203     299835    2457600
+            #      1207      54684    2457600
+            #      1210     304939    2457600
+            #1000001212      13493    2457600
+            for line in user_beancounters.split('\n'):
+                if line == '':
+                    continue
+                line = re.sub(r'^\s+', '', line)
+                splited_line = re.split('\s+', line)
+                if len(splited_line) != 3:
+                    continue
+                ctid, privvmpages, limit = splited_line
+                privvmpages = int(privvmpages)
+                privvmpages = privvmpages * 4096
+                limit = int(limit)
+                limit = limit * 4096
+                measures['openvz']['/' + ctid] = (privvmpages, limit)
+            SCHEDULE.account('openvz', monotonic() - start)
+
+        for ctid, (privvmpages, limit) in measures['openvz'].items():
+            if ctid not in cur or 'tasks' not in cur[ctid]:
                 continue
-            privvmpages = int(privvmpages)
-            privvmpages = privvmpages * 4096
-            limit = int(limit)
-            limit = limit * 4096
             cur[ctid]['memory.usage_in_bytes'] = privvmpages
             cur[ctid]['memory.limit_in_bytes'] = min(limit, measures['global']['total_memory'])
+        timings.append(('read:openvz', monotonic() - start))
+
+    if 'owner' in due:
+        SCHEDULE.account('owner', METADATA.cost)
 
     # Sanity check: any data at all ?
     if not len(cur):
@@ -489,87 +1474,322 @@ def collect(measures):
 
     # Apply
     measures['data'] = cur
+    measures['timings'] = timings
 
-def built_statistics(measures, conf):
+def built_statistics(measures, conf, now=None, record_history=True):
     # Time
     prev_time = measures['global'].get('time', -1)
-    cur_time = time.time()
+    cur_time = time.time() if now is None else now
     time_delta = cur_time - prev_time
     measures['global']['time'] = cur_time
-    cpu_to_percent = measures['global']['scheduler_frequency'] * measures['global']['total_cpu'] * time_delta
+
+    # Rates cover the time actually elapsed since each metric's previous
+    # sample, which is not the refresh time once per-metric intervals differ
+    elapsed = dict((metric, time_delta) for metric in METRIC_KEYS)
+    elapsed.update((metric, delta) for metric, delta in measures.get('elapsed', {}).items() if delta)
+    cpu_to_percent = measures['global']['scheduler_frequency'] * measures['global']['total_cpu'] * elapsed['cpu']
+    ticks_to_usec = 1000000.0 / measures['global']['scheduler_frequency']
+    usec_delta = dict((resource_name, elapsed[metric] * 1000000.0) for metric, resource_name in PRESSURE_RESOURCES.items())
 
     # Build data lines
     results = []
     for cgroup, data in measures['data'].items():
         cpu_usage = data.get('cpuacct.stat.diff', {})
-        line = {
-            'owner': str(data.get('owner', 'nobody')),
-            'type': str(data.get('type', 'cgroup')),
-            'cur_tasks': len(data['tasks']),
-            'max_tasks': data.get('pids.max', 'max'),
-            'memory_cur_bytes': data.get('memory.usage_in_bytes', 0),
-            'memory_limit_bytes': data.get('memory.limit_in_bytes', measures['global']['total_memory']),
-            'cpu_total_seconds': data.get('cpuacct.stat', {}).get('system', 0) + data.get('cpuacct.stat', {}).get('user', 0),
-            'cpu_syst': cpu_usage.get('system', 0) / cpu_to_percent,
-            'cpu_user': cpu_usage.get('user', 0) / cpu_to_percent,
-            'blkio_bw_bytes': data.get('blkio.throttle.io_service_bytes.diff', {}).get('total', 0),
-            'cgroup': cgroup,
-        }
-        line['cpu_total'] = line['cpu_syst'] + line['cpu_user'],
-        line['cpu_total_str'] = to_human_time(line['cpu_total_seconds'])
-        line['memory_cur_percent'] = line['memory_cur_bytes'] / line['memory_limit_bytes']
-        line['memory_cur_str'] = "{0: >7}/{1: <7}".format(to_human(line['memory_cur_bytes']), to_human(line['memory_limit_bytes']))
-        line['tasks'] = "{0: >5}/{1: <5}".format(line['cur_tasks'], line['max_tasks'])
-        line['blkio_bw'] = to_human(line['blkio_bw_bytes'], 'B/s')
+        cpu_stat = data.get('cpuacct.stat', {})
+        line = Row()
+        line.cgroup = cgroup
+        line.host = ''
+        line.owner = str(data.get('owner', 'nobody'))
+        line.type = str(data.get('type', 'cgroup'))
+        line.image = data.get('image', '')
+        line.cur_tasks = len(data['tasks'])
+        line.max_tasks = data.get('pids.max', 'max')
+        line.memory_cur_bytes = data.get('memory.usage_in_bytes', 0)
+        line.memory_limit_bytes = data.get('memory.limit_in_bytes', measures['global']['total_memory'])
+        line.cpu_total_seconds = cpu_stat.get('system', 0) + cpu_stat.get('user', 0)
+        line.cpu_syst = cpu_usage.get('system', 0) / cpu_to_percent
+        line.cpu_user = cpu_usage.get('user', 0) / cpu_to_percent
+        line.cpu_total = line.cpu_syst + line.cpu_user
+        line.blkio_bw_bytes = data.get('blkio.throttle.io_service_bytes.diff', {}).get('total', 0) / elapsed['blkio']
+        line.blkio_total_bytes = data.get('blkio.throttle.io_service_bytes', {}).get('Total', 0)
+        line.cpu_user_usec = int(cpu_stat.get('user', 0) * ticks_to_usec)
+        line.cpu_syst_usec = int(cpu_stat.get('system', 0) * ticks_to_usec)
+        line.memory_cur_percent = line.memory_cur_bytes / line.memory_limit_bytes
+        line.tasks_percent = line.cur_tasks / float(line.max_tasks) if isinstance(line.max_tasks, int) and line.max_tasks else 0.0
+
+        # Contention: share of the refresh interval spent stalled or throttled
+        for resource_name in ('cpu', 'memory', 'io'):
+            key = resource_name + '.pressure'
+            setattr(line, resource_name + '_pressure', data.get(key + '.diff', {}).get('some', 0) / usec_delta[resource_name])
+            setattr(line, resource_name + '_pressure_usec', data.get(key, {}).get('some', 0))
+        throttling = data.get('cpu.throttling', {})
+        throttling_diff = data.get('cpu.throttling.diff', {})
+        line.nr_throttled = throttling_diff.get('nr_throttled', 0)
+        line.nr_throttled_total = throttling.get('nr_throttled', 0)
+        line.throttled = throttling_diff.get('throttled_usec', 0) / usec_delta['cpu']
+        line.throttled_usec = throttling.get('throttled_usec', 0)
         results.append(line)
 
+    if record_history:
+        HISTORY.record(results)
     return results
 
-def render_tree(results, tree, level=0, prefix=[], node='/'):
-    # Exit condition
-    if node not in tree:
-        return
+class Row(object):
+    '''
+    Statistics of one cgroup for one refresh. Only raw, numeric, fields are
+    filled by ``built_statistics()``, so that sorting works on them directly.
+    Human readable strings and history fields are computed on access, that is
+    only for the rows actually displayed (or the sort column).
 
-    # Iteration
-    for i, line in enumerate(tree[node]):
-        cgroup = line['cgroup']
+    Also supports read/write ``line['field']`` and ``line.get('field')``.
+    '''
+    __slots__ = (
+        'cgroup', 'host', 'owner', 'type', 'image', 'cur_tasks', 'max_tasks',
+        'memory_cur_bytes', 'memory_limit_bytes', 'memory_cur_percent',
+        'cpu_total_seconds', 'cpu_syst', 'cpu_user', 'cpu_total',
+        'cpu_user_usec', 'cpu_syst_usec', 'blkio_bw_bytes', 'blkio_total_bytes',
+        'cpu_pressure', 'memory_pressure', 'io_pressure',
+        'cpu_pressure_usec', 'memory_pressure_usec', 'io_pressure_usec',
+        'nr_throttled', 'nr_throttled_total', 'throttled', 'throttled_usec',
+        'tasks_percent', '_tree', '_history',
+    )
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            return default
+
+    def __getattr__(self, name):
+        # Only called for unknown or unset attributes. History fields are named
+        # '<metric>_<stat>[_str]', like 'cpu_p95' or 'memory_avg_str'.
+        parts = name.split('_')
+        if len(parts) > 1 and parts[0] in History.METRICS and parts[1] in History.STATS:
+            return HISTORY.field(self.cgroup, parts[0], parts[1], human=parts[-1] == 'str', state=self.get('_history'))
+        raise AttributeError(name)
 
-        # Build name
-        if i == len(tree[node]) - 1:
-            line['_tree'] = prefix + [curses.ACS_LLCORNER, curses.ACS_HLINE, ' ']
-            _child_prefix = prefix + [' ', ' ', ' ']
-        else:
-            line['_tree'] = prefix + [curses.ACS_LTEE, curses.ACS_HLINE, ' ']
-            _child_prefix = prefix + [curses.ACS_VLINE, ' ', ' ']
+    @property
+    def cpu_total_str(self):
+        return to_human_time(self.cpu_total_seconds)
 
-        # Commit, fold or recurse
-        results.append(line)
-        if cgroup not in CONFIGURATION['fold']:
-            render_tree(results, tree, level+1, _child_prefix, cgroup)
+    @property
+    def memory_cur_str(self):
+        return "{0: >7}/{1: <7}".format(to_human(self.memory_cur_bytes), to_human(self.memory_limit_bytes))
+
+    @property
+    def tasks(self):
+        return "{0: >5}/{1: <5}".format(self.cur_tasks, self.max_tasks)
+
+    @property
+    def blkio_bw(self):
+        return to_human(self.blkio_bw_bytes, 'B/s')
+
+## History
+
+SPARK_CHARS = u' \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+SPARK_CHARS_ASCII = ' .:-=+*#%@'
+
+def sparkline(values, width):
+    '''
+    Render the last ``width`` values as a sparkline, scaled to their maximum
+    '''
+    values = values[-width:]
+    chars = SPARK_CHARS
+    if 'utf' not in locale.getpreferredencoding().lower():
+        chars = SPARK_CHARS_ASCII
+
+    top = max(values) if values else 0
+    if top <= 0:
+        return chars[0] * len(values)
+    scale = (len(chars) - 1) / float(top)
+    return u''.join(chars[int(round(max(v, 0) * scale))] for v in values)
+
+class History(object):
+    '''
+    Last ``window`` samples of a few metrics, per cgroup. Each cgroup gets one
+    fixed-size array('d') used as a ring buffer per metric, so that memory is
+    bounded by the number of cgroups times the window length.
+    '''
+    # History prefix -> built_statistics() field
+    METRICS = OrderedDict([
+        ('cpu',    'cpu_total'),
+        ('memory', 'memory_cur_bytes'),
+        ('blkio',  'blkio_bw_bytes'),
+        ('tasks',  'cur_tasks'),
+    ])
+    STATS = ('spark', 'min', 'avg', 'p95')
+
+    def __init__(self, window):
+        self.window = window
+        self.pos = -1
+        # cgroup -> (array, number of samples)
+        self.buffers = {}
+
+    def record(self, results):
+        '''
+        Record one sample for each line of ``results``. Forget cgroups that are
+        gone.
+
+        Buffers are written in place. Each ring has one spare slot, and every
+        recorded row keeps the (buffer, position, count) of its refresh: the
+        UI thread computes the fields of a row from the window of the refresh
+        that built it while the sampler records the next one.
+        '''
+        window = self.window
+        slots = window + 1
+        size = slots * len(self.METRICS)
+        pos = self.pos = (self.pos + 1) % slots
+        fields = operator.attrgetter(*self.METRICS.values())
+        buffers = {}
+        for line in results:
+            entry = self.buffers.get(line.cgroup)
+            if entry is None or len(entry[0]) != size:
+                buf, count = array('d', [0.0]) * size, 0
+            else:
+                buf, count = entry
+            for i, value in enumerate(fields(line)):
+                buf[i * slots + pos] = value
+            count = min(count + 1, window)
+            buffers[line.cgroup] = (buf, count)
+            line._history = (buf, pos, count)
+        self.buffers = buffers
+
+    def samples(self, cgroup, metric, state=None):
+        '''
+        Return the samples of ``metric`` for ``cgroup``, oldest first, from
+        the ``state`` of a recorded row or the latest refresh
+        '''
+        if state is None:
+            entry = self.buffers.get(cgroup)
+            if entry is None:
+                return []
+            state = (entry[0], self.pos, entry[1])
+        buf, pos, count = state
+        slots = len(buf) // len(self.METRICS)
+        base = list(self.METRICS).index(metric) * slots
+        start = pos - count + 1
+        return [buf[base + (start + i) % slots] for i in range(count)]
+
+    def field(self, cgroup, metric, stat, human=False, state=None):
+        '''
+        Compute ``stat`` ('spark', 'min', 'avg' or 'p95') of ``metric`` over the
+        window for ``cgroup``. Return a human readable string if ``human``.
+        '''
+        values = self.samples(cgroup, metric, state)
+        if stat == 'spark':
+            return sparkline(values, 20)
+
+        ordered = sorted(values) or [0]
+        if stat == 'min':
+            value = ordered[0]
+        elif stat == 'avg':
+            value = sum(ordered) / len(ordered)
         else:
-            line['_tree'] [-2] = '+'
+            value = ordered[int(0.95 * (len(ordered) - 1))]
+
+        if not human:
+            return value
+        return to_human(value, 'B/s' if metric == 'blkio' else 'B')
+
+HISTORY = History(CONFIGURATION['history'])
 
-def filter_tree(tree, keep, node='/'):
+class TreeIndex(object):
     '''
-    Keep a branch if and only if it is of of a 'keep' type or has a child of
-    the 'keep' type
+    Persistent parent index of the cgroups, updated with the cgroups added or
+    removed since the previous refresh only. The type filter result is cached
+    until the cgroup set or the filter changes. Rendering is iterative, so
+    deep hierarchies can not hit the recursion limit.
     '''
-    filtered = []
+    def __init__(self):
+        self.parents = {}
+        self.version = 0
+        self.filter_key = None
+        self.kept = None
+
+    def update(self, results):
+        names = set(line.cgroup for line in results)
+        if len(names) == len(self.parents) and all(name in self.parents for name in names):
+            return
+
+        for name in [name for name in self.parents if name not in names]:
+            del self.parents[name]
+        for name in names:
+            if name not in self.parents:
+                self.parents[name] = os.path.dirname(name)
+        self.version += 1
+
+    def filter(self, results, keep):
+        '''
+        Return the set of cgroups of a 'keep' type or with a descendant of a
+        'keep' type
+        '''
+        key = (self.version, tuple(keep))
+        if key == self.filter_key:
+            return self.kept
+
+        kept = set()
+        for line in results:
+            if line.type not in keep:
+                continue
+            # Mark the branch up to the first already kept ancestor
+            name = line.cgroup
+            while name not in kept:
+                kept.add(name)
+                parent = self.parents.get(name, name)
+                if parent == name:
+                    break
+                name = parent
+
+        self.filter_key, self.kept = key, kept
+        return kept
+
+    def render(self, results, fold, kept=None):
+        '''
+        Render sorted ``results`` as a tree. Siblings keep the order of
+        ``results``.
+        '''
+        rendered = []
+        children = defaultdict(list)
+        for line in results:
+            parent = self.parents[line.cgroup]
+            if parent == line.cgroup:
+                # Root cgroup
+                rendered.append(line)
+            elif kept is None or line.cgroup in kept:
+                children[parent].append(line)
+
+        # Depth first, with an explicit stack of (siblings, position, prefix)
+        stack = [(children.get('/', []), 0, [])]
+        while stack:
+            siblings, i, prefix = stack.pop()
+            if i >= len(siblings):
+                continue
+            stack.append((siblings, i + 1, prefix))
 
-    # Filter
-    for cgroup in tree.get(node, []):
-        if filter_tree(tree, keep, cgroup['cgroup']):
-            filtered.append(cgroup)
-        elif cgroup['type'] in keep:
-            filtered.append(cgroup)
+            line = siblings[i]
+            if i == len(siblings) - 1:
+                line['_tree'] = prefix + [curses.ACS_LLCORNER, curses.ACS_HLINE, ' ']
+                child_prefix = prefix + [' ', ' ', ' ']
+            else:
+                line['_tree'] = prefix + [curses.ACS_LTEE, curses.ACS_HLINE, ' ']
+                child_prefix = prefix + [curses.ACS_VLINE, ' ', ' ']
 
-    # Commit
-    if filtered:
-        tree[node] = filtered
-    else:
-        tree.pop(node, None)
+            # Commit, fold or descend
+            rendered.append(line)
+            if line.cgroup in fold:
+                line['_tree'][-2] = '+'
+            elif line.cgroup in children:
+                stack.append((children[line.cgroup], 0, child_prefix))
+
+        return rendered
 
-    return bool(filtered)
+TREE = TreeIndex()
 
 def prepare_tree(results):
     '''
@@ -585,49 +1805,478 @@ def prepare_tree(results):
         return [l for l in results if l['type'] in CONFIGURATION['type']]
 
     ## Tree view
-    tree = {}
-    rendered = []
+    TREE.update(results)
+    kept = TREE.filter(results, CONFIGURATION['type']) if CONFIGURATION['type'] else None
+    return TREE.render(results, set(CONFIGURATION['fold']), kept)
 
-    # Build tree
-    for line in results:
-        cgroup = line['cgroup']
-        parent = os.path.dirname(cgroup)
+# Last prepared view, reused until results or view settings change
+VIEW_CACHE = {'key': None, 'results': None, 'rendered': [], 'cgroups': [], 'index': {}}
 
-        # Root cgroup ?
-        if parent == cgroup:
-            rendered.append(line)
-            continue
+def prepare_view(results, conf):
+    '''
+    Sort, filter and render ``results``. Cached until a new snapshot or a view
+    setting change, so that moving around does not rebuild anything.
+    '''
+    key = (conf['sort_by'], conf['sort_asc'], conf['tree'], tuple(conf['fold']), tuple(conf['type']))
+    if VIEW_CACHE['key'] != key or VIEW_CACHE['results'] is not results:
+        start = monotonic()
+        rendered = sorted(results, key=operator.attrgetter(conf['sort_by']), reverse=not conf['sort_asc'])
+        TIMINGS.add('sort', monotonic() - start)
+
+        start = monotonic()
+        rendered = prepare_tree(rendered)
+        TIMINGS.add('tree', monotonic() - start)
+        cgroups = [line.cgroup for line in rendered]
+        index = dict((name, i) for i, name in enumerate(cgroups))
+        VIEW_CACHE.update(key=key, results=results, rendered=rendered, cgroups=cgroups, index=index)
+    return VIEW_CACHE['rendered'], VIEW_CACHE['cgroups'], VIEW_CACHE['index']
+
+class PhaseTimings(object):
+    '''
+    Duration of the last run of each phase of the main loop, and totals to
+    average them. The sampler and UI threads each record their own phases.
+    '''
+    def __init__(self):
+        self.last = OrderedDict()
+        self.total = defaultdict(float)
+        self.count = defaultdict(int)
 
-        # Insert in hierarchie as needed
-        if parent not in tree:
-            tree[parent] = []
-        tree[parent].append(line)
+    def add(self, phase, duration):
+        self.last[phase] = duration
+        self.total[phase] += duration
+        self.count[phase] += 1
 
-    # If there are filters, filter
-    if CONFIGURATION['type']:
-         filter_tree(tree, CONFIGURATION['type'])
+    def average(self, phase):
+        return self.total[phase] / max(1, self.count[phase])
 
-    # Render tree, starting from root
-    render_tree(rendered, tree)
-    return rendered
+TIMINGS = PhaseTimings()
 
-def display(scr, results, conf):
-    # Sort and render
-    results = sorted(results, key=lambda line: line.get(conf['sort_by'], 0), reverse=not conf['sort_asc'])
-    results = prepare_tree(results)
+Process = namedtuple('Process', ['pid', 'comm', 'state', 'threads', 'cpu_percent', 'rss_bytes', 'io_bw_bytes'])
+
+class ProcessSampler(object):
+    '''
+    Per-task statistics of a single cgroup, for the drill-down view. Reads
+    ``/proc/<pid>/{stat,statm,io}`` through a dedicated ``StatFileCache`` so
+    that descriptors are reused between refreshes. Each refresh stops after
+    ``budget`` seconds; the next one resumes where it left, round-robin, so
+    that huge cgroups are covered over several refreshes instead of stalling
+    the sampler. Rates are computed over each task's own sampling interval.
+    '''
+    BUDGET = 0.1            # seconds per refresh
+    CHECK_EVERY = 32        # tasks between budget checks
+
+    def __init__(self, files, budget=BUDGET):
+        self.files = files
+        self.budget = budget
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.hz = float(os.sysconf('SC_CLK_TCK'))
+        self.reset(None)
+
+    def reset(self, cgroup):
+        self.cgroup = cgroup
+        self.prev = {}      # pid -> (time, cpu ticks, io bytes)
+        self.rows = {}      # pid -> latest Process
+        self.cursor = 0
+        self.sampled = 0
+        self.files.retain(())
+
+    def _read_pid(self, pid, now):
+        base = '/proc/%d/' % pid
+        stat = self.files.read(base + 'stat')
+        if not stat:
+            # Reused descriptor of an exited task
+            raise IOError(errno.ESRCH, os.strerror(errno.ESRCH), base + 'stat')
+
+        # 'pid (comm) state ppid ...', comm may contain spaces and parenthesis
+        head, _, tail = stat.rpartition(')')
+        comm = head.partition('(')[2]
+        fields = tail.split()
+        cpu_ticks = int(fields[11]) + int(fields[12])
+        rss_bytes = int(self.files.read(base + 'statm').split()[1]) * self.page_size
+
+        # Other users' I/O counters are only readable by root
+        io_bytes = None
+        try:
+            io = dict(l.split(':', 1) for l in self.files.read(base + 'io').splitlines() if ':' in l)
+            io_bytes = int(io['read_bytes']) + int(io['write_bytes'])
+        except (IOError, KeyError, ValueError):
+            pass
+
+        cpu_percent, io_bw_bytes = None, None
+        if pid in self.prev:
+            prev_time, prev_ticks, prev_io = self.prev[pid]
+            elapsed = now - prev_time
+            if elapsed > 0:
+                cpu_percent = (cpu_ticks - prev_ticks) / self.hz / elapsed
+                if io_bytes is not None and prev_io is not None:
+                    io_bw_bytes = (io_bytes - prev_io) / elapsed
+        self.prev[pid] = (now, cpu_ticks, io_bytes)
+        self.rows[pid] = Process(pid, comm, fields[0], int(fields[17]), cpu_percent, rss_bytes, io_bw_bytes)
+
+    def _forget(self, pid):
+        self.prev.pop(pid, None)
+        self.rows.pop(pid, None)
+        for name in ('stat', 'statm', 'io'):
+            self.files.close('/proc/%d/%s' % (pid, name))
+
+    def sample(self, cgroup, pids, now):
+        '''
+        Refresh as many tasks of ``cgroup`` as the budget allows and return
+        the list of known ``Process``
+        '''
+        if cgroup != self.cgroup:
+            self.reset(cgroup)
+
+        pids = sorted(set(pids))
+        alive = set(pids)
+        for pid in [pid for pid in self.rows if pid not in alive]:
+            self._forget(pid)
+
+        deadline = monotonic() + self.budget
+        start = self.cursor % len(pids) if pids else 0
+        done = 0
+        for pid in pids[start:] + pids[:start]:
+            if done % self.CHECK_EVERY == 0 and done and monotonic() > deadline:
+                break
+            try:
+                self._read_pid(pid, now)
+            except (IOError, OSError, IndexError, ValueError):
+                # Exited or unreadable task
+                self._forget(pid)
+            done += 1
+
+        self.cursor = start + done
+        self.sampled = done
+        return list(self.rows.values())
+
+# Process files are not cgroup files, keep them in their own descriptor budget
+PROCESSES = ProcessSampler(StatFileCache(max(64, stat_file_budget() // 2)))
+
+Snapshot = namedtuple('Snapshot', ['seq', 'time', 'results', 'processes'])
 
-    CONFIGURATION['cgroups'] = [cgroup['cgroup'] for cgroup in results]
+class Sampler(threading.Thread):
+    '''
+    Collect measures in the background and publish each refresh as an
+    immutable ``Snapshot``, so that a slow collection never blocks keyboard
+    handling. The UI thread only ever reads ``latest()``.
+    '''
+    def __init__(self, measures, replayer=None, recorder=None, fanin=None, profile=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.measures = measures
+        self.replayer = replayer
+        self.recorder = recorder
+        self.fanin = fanin
+        self.snapshot = None
+        self.error = None
+        self.stopped = False
+        self.wakeup = threading.Event()
+        self.profiler = cProfile.Profile() if profile else None
+        self.profiling = False
+
+    def sample(self):
+        tick_start = monotonic()
+        if self.fanin is not None:
+            # Remote rows are built as frames arrive, only merge them
+            now, interval = time.time(), CONFIGURATION['refresh_interval']
+            results = self.fanin.results()
+            HISTORY.record(results)
+        else:
+            if self.replayer is None:
+                now = time.time()
+                collect(self.measures)
+                for phase, duration in self.measures['timings']:
+                    TIMINGS.add(phase, duration)
+                interval = SCHEDULE.next_delay(time.time())
+            else:
+                now, interval = self.replayer.step(self.measures, CONFIGURATION)
+
+            start = monotonic()
+            record_history = self.replayer is not None or SCHEDULE.history_due(now)
+            results = built_statistics(self.measures, CONFIGURATION, now, record_history)
+            TIMINGS.add('build', monotonic() - start)
+            if self.recorder is not None:
+                self.recorder.write(self.measures, now)
+
+        if ALERTS.rules:
+            start = monotonic()
+            ALERTS.evaluate(results, now)
+            TIMINGS.add('alerts', monotonic() - start)
+
+        # Drill-down: tasks of the selected cgroup. Live data only.
+        processes = None
+        drilldown = CONFIGURATION['drilldown']
+        if drilldown is not None and self.replayer is None and self.fanin is None:
+            start = monotonic()
+            pids = self.measures.get('processes')
+            if pids is None:
+                pids = self.measures['data'].get(drilldown, {}).get('tasks', [])
+            processes = tuple(PROCESSES.sample(drilldown, pids, now))
+            TIMINGS.add('processes', monotonic() - start)
+        elif PROCESSES.cgroup is not None:
+            # Left drill-down: release /proc descriptors
+            PROCESSES.reset(None)
+
+        # Publish. Never touched again by this thread.
+        seq = self.snapshot.seq + 1 if self.snapshot else 0
+        self.snapshot = Snapshot(seq, now, tuple(results), processes)
+        TIMINGS.add('tick', monotonic() - tick_start)
+        return interval
+
+    def run(self):
+        try:
+            if self.profiler is not None:
+                self.profiler.enable()
+                self.profiling = True
+            while not self.stopped:
+                deadline = time.time() + self.sample()
+
+                # Sleep until next refresh, a seek request, a new drill-down or stop
+                while not self.stopped and not CONFIGURATION['replay_seek'] and \
+                      (self.replayer is not None or self.fanin is not None or CONFIGURATION['drilldown'] == PROCESSES.cgroup) and \
+                      (CONFIGURATION['pause_refresh'] or time.time() < deadline):
+                    self.wakeup.wait(max(0, min(0.1, deadline - time.time())) or 0.1)
+                    self.wakeup.clear()
+        except BaseException as e:
+            # Including KeyboardInterrupt when there is nothing to collect
+            self.error = e
+        finally:
+            if self.profiling:
+                self.profiler.disable()
+                self.profiling = False
+
+    def latest(self):
+        '''
+        Return latest snapshot, if any. Re-raise sampling errors.
+        '''
+        if self.error is not None:
+            raise self.error
+        return self.snapshot
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+class ScreenBuffer(object):
+    '''
+    Off-screen frame exposing the subset of the curses window API used by
+    ``display()``. ``flush()`` compares the frame with the previously flushed
+    one and only sends the cells that changed, instead of clearing and
+    redrawing the whole screen. ``bytes_written`` counts the bytes of cell
+    content sent for the last frame.
+    '''
+    BLANK = (' ', 0)
+
+    def __init__(self):
+        self.prev = None
+        self.rows = []
+        self.height = self.width = 0
+        self.y = self.x = 0
+        self.bytes_written = 0
+        self.total_bytes_written = 0
+        self.frames = 0
+
+    def invalidate(self):
+        '''
+        Force a full redraw on next flush, when the screen was altered behind
+        our back
+        '''
+        self.prev = None
+
+    def begin(self, scr):
+        self.height, self.width = scr.getmaxyx()
+        self.rows = [[self.BLANK] * self.width for _ in range(self.height)]
+        self.y = self.x = 0
+        return self
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def _put(self, y, x, chars, attr):
+        # Mimic curses: wrap on next line, fail when out of the screen
+        if not 0 <= y < self.height or not 0 <= x < self.width:
+            raise _curses.error("addstr() returned ERR")
+
+        for ch in chars:
+            self.rows[y][x] = (ch, attr)
+            x += 1
+            if x == self.width:
+                x, y = 0, y + 1
+                if y == self.height:
+                    self.y, self.x = self.height - 1, self.width - 1
+                    raise _curses.error("addstr() returned ERR")
+        self.y, self.x = y, x
+
+    def addstr(self, *args):
+        if len(args) > 2 or (len(args) == 2 and not isinstance(args[0], (str, type(u'')))):
+            y, x, text = args[:3]
+            attr = args[3] if len(args) > 3 else 0
+        else:
+            y, x = self.y, self.x
+            text = args[0]
+            attr = args[1] if len(args) > 1 else 0
+        self._put(y, x, text, attr)
+
+    def addch(self, *args):
+        if len(args) > 2:
+            y, x, ch = args[:3]
+            attr = args[3] if len(args) > 3 else 0
+        else:
+            y, x = self.y, self.x
+            ch = args[0]
+            attr = args[1] if len(args) > 1 else 0
+        self._put(y, x, [ch], attr)
+
+    def flush(self, scr):
+        full = self.prev is None or len(self.prev) != self.height or \
+               (self.prev and len(self.prev[0]) != self.width)
+        if full:
+            scr.erase()
+
+        written = 0
+        for y, row in enumerate(self.rows):
+            old = None if full else self.prev[y]
+            if old == row:
+                continue
+
+            x = 0
+            while x < self.width:
+                if old is not None and old[x] == row[x]:
+                    x += 1
+                    continue
+
+                start, (ch, attr) = x, row[x]
+                try:
+                    if isinstance(ch, int):
+                        # Line drawing chars
+                        scr.addch(y, x, ch, attr)
+                        written += 1
+                        x += 1
+                        continue
+
+                    # Group changed cells with the same attributes
+                    chars = []
+                    while x < self.width and row[x][1] == attr and not isinstance(row[x][0], int) and \
+                          (old is None or old[x] != row[x]):
+                        chars.append(row[x][0])
+                        x += 1
+                    text = u''.join(chars)
+                    written += len(text.encode('utf-8'))
+                    scr.addstr(y, start, text, attr)
+                except _curses.error:
+                    # Bottom right cell can be drawn, but curses complains
+                    pass
+
+        scr.noutrefresh()
+        curses.doupdate()
+
+        self.prev = self.rows
+        self.bytes_written = written
+        self.total_bytes_written += written
+        self.frames += 1
+
+FRAME = ScreenBuffer()
+
+def display_timings(buf, height, width):
+    '''
+    Overlay the last and average duration of each phase, top right
+    '''
+    lines = ['{0:<14} {1:>9} {2:>9}'.format('PHASE', 'LAST', 'AVG')]
+    for phase, last in list(TIMINGS.last.items()):
+        lines.append('{0:<14} {1:>7.2f}ms {2:>7.2f}ms'.format(phase, last * 1000, TIMINGS.average(phase) * 1000))
+    for metric in SCHEDULE.METRICS:
+        if SCHEDULE.stretch[metric] > 1:
+            lines.append('{0:<14} {1:>8.2f}s {2:>9}'.format('every:' + metric, SCHEDULE.interval(metric), 'x%d' % SCHEDULE.stretch[metric]))
+
+    x = max(0, width - len(lines[0]) - 2)
+    for y, line in enumerate(lines, 1):
+        if y >= height - 1:
+            # Keep status line
+            break
+        try:
+            buf.addstr(y, x, (' ' + line + ' ')[:width - x], curses.color_pair(1 if y == 1 else 2))
+        except _curses.error:
+            pass
+
+def display_processes(scr, processes, conf):
+    '''
+    Drill-down view: tasks of the selected cgroup, busiest first
+    '''
+    buf = FRAME.begin(scr)
+    height, width = buf.getmaxyx()
+    list_height = max(1, height - 2)
+    CONFIGURATION['list_height'] = list_height
+
+    processes = sorted(processes or (), key=lambda p: (p.cpu_percent or 0, p.rss_bytes), reverse=True)
+    max_offset = max(0, len(processes) - list_height)
+    CONFIGURATION['drilldown_offset'] = min(max(0, CONFIGURATION['drilldown_offset']), max_offset)
+    offset = CONFIGURATION['drilldown_offset']
+
+    # Title line
+    line_tpl = u'{0:>7} {1:<16} {2:1} {3:>5} {4:>6} {5:>10} {6:>12}'
+    try:
+        buf.addstr(0, 0, ' '*width, curses.color_pair(1))
+        buf.addstr(0, 0, line_tpl.format('PID', 'COMMAND', 'S', 'THR', 'CPU', 'RSS', 'IO'), curses.color_pair(1))
+    except _curses.error:
+        pass
+
+    # Content, only visible lines
+    lineno = 1
+    for proc in processes[offset:offset+list_height]:
+        line = line_tpl.format(
+            proc.pid,
+            proc.comm[:16],
+            proc.state,
+            proc.threads,
+            '-' if proc.cpu_percent is None else '{0:.1%}'.format(proc.cpu_percent),
+            to_human(proc.rss_bytes),
+            '-' if proc.io_bw_bytes is None else to_human(proc.io_bw_bytes, 'B/s'),
+        )
+        try:
+            buf.addstr(lineno, 0, line[:width])
+        except _curses.error:
+            break
+        lineno += 1
+
+    # Status line
+    color = curses.color_pair(2)
+    try:
+        try:
+            buf.addstr(height-1, 0, ' '*(width), color)
+        except _curses.error:
+            pass
+        buf.addstr(height-1, 0, " CTOP ", color)
+        buf.addch(curses.ACS_VLINE, color)
+        buf.addstr(" [D] Back ", color)
+        buf.addch(curses.ACS_VLINE, color)
+        if processes:
+            buf.addstr(" %s: %d tasks, %d refreshed " % (conf['drilldown'], len(processes), PROCESSES.sampled), color)
+        else:
+            buf.addstr(" %s: sampling... " % conf['drilldown'], color)
+        buf.addch(curses.ACS_VLINE, color)
+        buf.addstr(" [Q]uit", color)
+    except _curses.error:
+        pass
+
+    FRAME.flush(scr)
+
+def display(scr, results, conf, processes=None):
+    if conf['drilldown'] is not None:
+        return display_processes(scr, processes, conf)
+
+    # Sort and render
+    results, CONFIGURATION['cgroups'], CONFIGURATION['cgroups_index'] = prepare_view(results, conf)
+    start = monotonic()
 
     # Ensure selected line name synced with num
     if results:
         if CONFIGURATION['follow']:
-            while True:
-                try:
-                    i = CONFIGURATION['cgroups'].index(CONFIGURATION['selected_line_name'])
-                    CONFIGURATION['selected_line_num'] = i
-                    break
-                except:
-                    CONFIGURATION['selected_line_name'] = os.path.dirname(CONFIGURATION['selected_line_name'])
+            # Selected cgroup vanished ? Fall back on its closest parent
+            name = CONFIGURATION['selected_line_name']
+            while name not in CONFIGURATION['cgroups_index'] and name not in ('', '/'):
+                name = os.path.dirname(name)
+            CONFIGURATION['selected_line_num'] = CONFIGURATION['cgroups_index'].get(name, 0)
+            CONFIGURATION['selected_line_name'] = CONFIGURATION['cgroups'][CONFIGURATION['selected_line_num']]
         else:
             CONFIGURATION['selected_line_num'] = min(len(results)-1, CONFIGURATION['selected_line_num'])
             CONFIGURATION['selected_line_name'] = CONFIGURATION['cgroups'][CONFIGURATION['selected_line_num']]
@@ -637,9 +2286,13 @@ def display(scr, results, conf):
         CONFIGURATION['selected_line_name'] = ''
         CONFIGURATION['selected_line'] = None
 
+    # Draw off-screen, only changed cells will be sent to the terminal
+    buf = FRAME.begin(scr)
+
     # Get display informations
-    height, width = scr.getmaxyx()
+    height, width = buf.getmaxyx()
     list_height = height - 2 # title + status lines
+    CONFIGURATION['list_height'] = max(1, list_height)
 
     # Update offset
     max_offset = max(0, len(results) - list_height)
@@ -654,12 +2307,10 @@ def display(scr, results, conf):
         CONFIGURATION['offset'] = max_offset
 
     # Display statistics
-    scr.clear()
-
     # Title line && templates
     x = 0
     line_tpl = []
-    scr.addstr(0, 0, ' '*width, curses.color_pair(1))
+    buf.addstr(0, 0, ' '*width, curses.color_pair(1))
 
     for col in COLUMNS:
         # Build templates
@@ -669,25 +2320,27 @@ def display(scr, results, conf):
         # Build title line
         color = 2 if col.col_sort == conf['sort_by'] else 1
         try:
-            scr.addstr(0, x, title_fmt.format(col.title)+' ', curses.color_pair(color))
+            buf.addstr(0, x, title_fmt.format(col.title)+' ', curses.color_pair(color))
         except:
             # Handle narrow screens
             break
         if col.width:
             x += col.width + 1
 
-    # Content
+    # Content, only visible lines are ever formatted
     lineno = 1
-    for line in results[CONFIGURATION['offset']:]:
+    for line in results[CONFIGURATION['offset']:CONFIGURATION['offset']+max(0, list_height)]:
         y = 0
         if lineno-1 == CONFIGURATION['selected_line_num']-CONFIGURATION['offset']:
             col_reg, col_tree = curses.color_pair(2), curses.color_pair(2)
+        elif line.cgroup in ALERTS.firing:
+            col_reg, col_tree = curses.color_pair(5), curses.color_pair(5)
         else:
             col_reg, col_tree = colors = curses.color_pair(0), curses.color_pair(4)
 
         # Draw line background
         try:
-            scr.addstr(lineno, 0, ' '*width, col_reg)
+            buf.addstr(lineno, 0, ' '*width, col_reg)
         except _curses.error:
             # Handle small screens
             break
@@ -702,10 +2355,10 @@ def display(scr, results, conf):
                     data_point = os.path.basename(data_point) or '[root]'
 
                     for c in line.get('_tree', []):
-                        scr.addch(c, col_tree)
+                        buf.addch(c, col_tree)
                         y+=1
 
-                scr.addstr(lineno, y, cell_tpl.format(data_point)+' ', col_reg)
+                buf.addstr(lineno, y, cell_tpl.format(data_point)+' ', col_reg)
                 if col.width:
                     y += col.width + 1
         except _curses.error:
@@ -714,54 +2367,81 @@ def display(scr, results, conf):
         lineno += 1
     else:
         # Make sure last line did not wrap, clear it if needed
-        try: scr.addstr(lineno, 0, ' '*width)
+        try: buf.addstr(lineno, 0, ' '*width)
         except _curses.error: pass
 
     # status line
     try:
         color = curses.color_pair(2)
         try:
-            scr.addstr(height-1, 0, ' '*(width), color)
+            buf.addstr(height-1, 0, ' '*(width), color)
         except:
             # Last char wraps, on purpose: draw full line
             pass
 
         selected = results[CONFIGURATION['selected_line_num']] if results else {}
 
-        scr.addstr(height-1, 0, " CTOP ", color)
-        scr.addch(curses.ACS_VLINE, color)
-        scr.addstr(" [P]ause: "+('On ' if CONFIGURATION['pause_refresh'] else 'Off '), color)
-        scr.addch(curses.ACS_VLINE, color)
-        scr.addstr(" [F]ollow: "+('On ' if CONFIGURATION['follow']  else 'Off ') , color)
-        scr.addch(curses.ACS_VLINE, color)
-        scr.addstr(" [F5] Toggle %s view "%('list' if CONFIGURATION['tree'] else 'tree'), color)
-        scr.addch(curses.ACS_VLINE, color)
+        buf.addstr(height-1, 0, " CTOP ", color)
+        buf.addch(curses.ACS_VLINE, color)
+        buf.addstr(" [P]ause: "+('On ' if CONFIGURATION['pause_refresh'] else 'Off '), color)
+        buf.addch(curses.ACS_VLINE, color)
+        buf.addstr(" [F]ollow: "+('On ' if CONFIGURATION['follow']  else 'Off ') , color)
+        buf.addch(curses.ACS_VLINE, color)
+        buf.addstr(" [F5] Toggle %s view "%('list' if CONFIGURATION['tree'] else 'tree'), color)
+        buf.addch(curses.ACS_VLINE, color)
+        if CONFIGURATION['replay'] is None and not CONFIGURATION['remote']:
+            buf.addstr(" [D] Tasks ", color)
+            buf.addch(curses.ACS_VLINE, color)
 
         # Fold control
         if CONFIGURATION['tree']:
-            scr.addstr(" [+/-] %s "%('unfold' if selected.get('cgroup', '') in CONFIGURATION['fold'] else 'fold'), color)
-            scr.addch(curses.ACS_VLINE, color)
+            buf.addstr(" [+/-] %s "%('unfold' if selected.get('cgroup', '') in CONFIGURATION['fold'] else 'fold'), color)
+            buf.addch(curses.ACS_VLINE, color)
 
-        # Do we have any actions available for *selected* line ?
-        selected_type = selected.get('type', '')
+        # Do we have any actions available for *selected* line ? Never for remote ones.
+        selected_type = selected.get('type', '') if not selected.get('host') else ''
         if selected_type == 'docker' and HAS_DOCKER or \
            selected_type in ['lxc', 'lxc-user'] and HAS_LXC or \
            selected_type == 'qemu-kvm' and HAS_LIBVIRT or \
            selected_type == 'openvz' and HAS_OPENVZ:
              if selected_type == 'openvz':
-                scr.addstr(" [A]ttach, [E]nter, [S]top, [C]hkpnt, [K]ill ", color)
+                buf.addstr(" [A]ttach, [E]nter, [S]top, [C]hkpnt, [K]ill ", color)
              elif selected_type == 'qemu-kvm':
-                scr.addstr(" [A]ttach, [S]top, [K]ill ", color)
+                buf.addstr(" [A]ttach, [S]top, [K]ill ", color)
              else:
-                scr.addstr(" [A]ttach, [E]nter, [S]top, [K]ill ", color)
-             scr.addch(curses.ACS_VLINE, color)
-
-        scr.addstr(" [Q]uit", color)
+                buf.addstr(" [A]ttach, [E]nter, [S]top, [K]ill ", color)
+             buf.addch(curses.ACS_VLINE, color)
+
+        # Self profiling
+        buf.addstr(" [T] tick %.1fms render %.1fms " % (TIMINGS.last.get('tick', 0) * 1000, TIMINGS.last.get('render', 0) * 1000), color)
+        buf.addch(curses.ACS_VLINE, color)
+
+        # Firing alerts
+        if ALERTS.firing:
+            firing = ALERTS.firing.get(selected.get('cgroup'))
+            buf.addstr(" %d alerting%s " % (len(ALERTS.firing), ': ' + firing[0] if firing else ''), color)
+            buf.addch(curses.ACS_VLINE, color)
+
+        # Incremental search
+        if CONFIGURATION['search'] is not None:
+            buf.addstr(" /%s " % CONFIGURATION['search'], color)
+            buf.addch(curses.ACS_VLINE, color)
+
+        # Replay position and controls
+        if CONFIGURATION['replay'] is not None:
+            buf.addstr(" %s [</>] x%g [Left/Right] seek " % (CONFIGURATION['replay'].status(), CONFIGURATION['replay_speed']), color)
+            buf.addch(curses.ACS_VLINE, color)
+
+        buf.addstr(" [Q]uit", color)
     except _curses.error:
         # Handle narrow screens
         pass
 
-    scr.refresh()
+    if CONFIGURATION['show_timings']:
+        display_timings(buf, height, width)
+
+    FRAME.flush(scr)
+    TIMINGS.add('render', monotonic() - start)
 
 def set_sort_col(sort_by):
     if CONFIGURATION['sort_by'] == sort_by:
@@ -769,39 +2449,127 @@ def set_sort_col(sort_by):
     else:
         CONFIGURATION['sort_by'] = sort_by
 
+def select_line(i):
+    '''Select line ``i`` of the current view, clamped to its bounds'''
+    cgroups = CONFIGURATION['cgroups']
+    if not cgroups:
+        return
+    i = max(0, min(i, len(cgroups)-1))
+    CONFIGURATION['selected_line_num'] = i
+    CONFIGURATION['selected_line_name'] = cgroups[i]
+
+def selected_index():
+    '''Position of the selected line in the current view'''
+    if CONFIGURATION['follow']:
+        return CONFIGURATION['cgroups_index'].get(CONFIGURATION['selected_line_name'], CONFIGURATION['selected_line_num'])
+    return CONFIGURATION['selected_line_num']
+
+def search_next(query, start):
+    '''Select first cgroup matching ``query`` from line ``start``, wrapping around'''
+    cgroups = CONFIGURATION['cgroups']
+    query = query.lower()
+    for k in range(len(cgroups)):
+        i = (start + k) % len(cgroups)
+        if query in cgroups[i].lower():
+            select_line(i)
+            return True
+    return False
+
+def on_search_key(c):
+    '''Handle keys while typing an incremental search'''
+    if c in (27, 10, 13, curses.KEY_ENTER):
+        # Escape / Enter: leave search mode, keep selection
+        CONFIGURATION['last_search'] = CONFIGURATION['search']
+        CONFIGURATION['search'] = None
+    elif c in (8, 127, curses.KEY_BACKSPACE):
+        CONFIGURATION['search'] = CONFIGURATION['search'][:-1]
+    elif 32 <= c < 127:
+        CONFIGURATION['search'] += chr(c)
+        search_next(CONFIGURATION['search'], selected_index())
+    return 2
+
+def on_drilldown_key(c):
+    '''Handle keys in the per-process drill-down view'''
+    if c == ord('q'):
+        raise KeyboardInterrupt()
+    elif c in (ord('d'), 27):
+        CONFIGURATION['drilldown'] = None
+    elif c == ord('p'):
+        CONFIGURATION['pause_refresh'] = not CONFIGURATION['pause_refresh']
+    elif c in (curses.KEY_DOWN, curses.KEY_UP, curses.KEY_NPAGE, curses.KEY_PPAGE):
+        # Scroll, clamped on display
+        CONFIGURATION['drilldown_offset'] += {
+            curses.KEY_DOWN: 1,
+            curses.KEY_UP: -1,
+            curses.KEY_NPAGE: CONFIGURATION['list_height'],
+            curses.KEY_PPAGE: -CONFIGURATION['list_height'],
+        }[c]
+    elif c == curses.KEY_HOME:
+        CONFIGURATION['drilldown_offset'] = 0
+    elif c == curses.KEY_END:
+        CONFIGURATION['drilldown_offset'] = sys.maxsize
+    else:
+        return 1
+    return 2
+
 def on_keyboard(c):
     '''Handle keyborad shortcuts'''
-    if c == ord('q'):
+    if CONFIGURATION['search'] is not None:
+        return on_search_key(c)
+    elif CONFIGURATION['drilldown'] is not None:
+        return on_drilldown_key(c)
+    elif c == ord('q'):
         raise KeyboardInterrupt()
     elif c == ord('p'):
         CONFIGURATION['pause_refresh'] = not CONFIGURATION['pause_refresh']
     elif c == ord('f'):
         CONFIGURATION['follow'] = not CONFIGURATION['follow']
         return 2
+    elif c == ord('t'):
+        CONFIGURATION['show_timings'] = not CONFIGURATION['show_timings']
+        return 2
     elif c == 269: # F5
         CONFIGURATION['tree'] = not CONFIGURATION['tree']
         return 2
     elif c == curses.KEY_DOWN:
-        if CONFIGURATION['follow']:
-            i = CONFIGURATION['cgroups'].index(CONFIGURATION['selected_line_name'])
-        else:
-            i = CONFIGURATION['selected_line_num']
-        i = min(i+1, len(CONFIGURATION['cgroups'])-1)
-        CONFIGURATION['selected_line_num'] = i
-        CONFIGURATION['selected_line_name'] = CONFIGURATION['cgroups'][i]
+        select_line(selected_index()+1)
         return 2
     elif c == curses.KEY_UP:
-        if CONFIGURATION['follow']:
-            i = CONFIGURATION['cgroups'].index(CONFIGURATION['selected_line_name'])
-        else:
-            i = CONFIGURATION['selected_line_num']
-        i = max(i-1, 0)
-        CONFIGURATION['selected_line_num'] = i
-        CONFIGURATION['selected_line_name'] = CONFIGURATION['cgroups'][i]
+        select_line(selected_index()-1)
+        return 2
+    elif c == curses.KEY_NPAGE:
+        select_line(selected_index()+CONFIGURATION['list_height'])
+        return 2
+    elif c == curses.KEY_PPAGE:
+        select_line(selected_index()-CONFIGURATION['list_height'])
+        return 2
+    elif c == curses.KEY_HOME:
+        select_line(0)
+        return 2
+    elif c == curses.KEY_END:
+        select_line(len(CONFIGURATION['cgroups'])-1)
+        return 2
+    elif c == ord('/'):
+        CONFIGURATION['search'] = ''
+        return 2
+    elif c == ord('n'):
+        if CONFIGURATION['last_search']:
+            search_next(CONFIGURATION['last_search'], selected_index()+1)
+        return 2
+    elif c in (curses.KEY_LEFT, curses.KEY_RIGHT, ord('['), ord(']')) and CONFIGURATION['replay'] is not None:
+        CONFIGURATION['replay_seek'] += {curses.KEY_LEFT: -10, curses.KEY_RIGHT: 10, ord('['): -60, ord(']'): 60}[c]
+        return 1
+    elif c in (ord('<'), ord('>')) and CONFIGURATION['replay'] is not None:
+        speed = CONFIGURATION['replay_speed'] * (2 if c == ord('>') else 0.5)
+        CONFIGURATION['replay_speed'] = min(64, max(1/64.0, speed))
         return 2
     elif CONFIGURATION['selected_line'] is None:
         # All following lines expect a valid selected line
         return 2
+    elif c == ord('d') and CONFIGURATION['replay'] is None and not CONFIGURATION['remote']:
+        CONFIGURATION['drilldown'] = CONFIGURATION['selected_line']['cgroup']
+        CONFIGURATION['drilldown_offset'] = 0
+        return 2
     elif c == ord('+') or c == ord('-'):
         cgroup = CONFIGURATION['selected_line']['cgroup']
         if cgroup in CONFIGURATION['fold']:
@@ -809,6 +2577,9 @@ def on_keyboard(c):
         else:
             CONFIGURATION['fold'].append(cgroup)
         return 2
+    elif CONFIGURATION['selected_line']['host'] or CONFIGURATION['replay'] is not None:
+        # Actions would run on this host, not the agent's or the captured one
+        return 2
     elif c == ord('a'):
         selected = CONFIGURATION['selected_line']
         selected_name = os.path.basename(selected['cgroup'])
@@ -901,11 +2672,8 @@ def on_mouse():
                     continue
                 return 2
         # Is it a cgroup line ?
-        elif y <= len(CONFIGURATION['cgroups']):
-            if CONFIGURATION['follow']:
-                CONFIGURATION['selected_line_name'] = CONFIGURATION['cgroups'][y-1]
-            else:
-                CONFIGURATION['selected_line_num'] = y-1
+        elif y-1 < min(CONFIGURATION['list_height'], len(CONFIGURATION['cgroups']) - CONFIGURATION['offset']):
+            select_line(CONFIGURATION['offset'] + y-1)
             return 2
     return 1
 
@@ -957,6 +2725,846 @@ Hint: It seems you have 'boot2docker' installed.
       $ docker run --volume=/sys/fs/cgroup:/sys/fs/cgroup:ro -it --rm yadutaf/ctop""", file=sys.stderr)
     devnull.close()
 
+## Record and replay
+
+RECORD_MAGIC = b'CTOPREC2'
+RECORD_HEADER = struct.Struct('>I')     # global data length
+RECORD_FRAME = struct.Struct('>BdI')    # frame kind, time, payload length
+FRAME_KEY = 1
+FRAME_DELTA = 2
+
+def frame_delta(prev, cur):
+    '''
+    Compute what changed from ``prev`` to ``cur`` measures data
+    '''
+    changed, unset = {}, {}
+    for name, data in cur.items():
+        old = prev.get(name)
+        if old is None:
+            changed[name] = data
+            continue
+
+        diff = dict((k, v) for k, v in data.items() if old.get(k) != v)
+        if diff:
+            changed[name] = diff
+        removed = [k for k in old if k not in data]
+        if removed:
+            unset[name] = removed
+
+    delta = {'set': changed}
+    if unset:
+        delta['unset'] = unset
+    removed = [name for name in prev if name not in cur]
+    if removed:
+        delta['del'] = removed
+    return delta
+
+def apply_frame_delta(data, delta):
+    for name in delta.get('del', []):
+        data.pop(name, None)
+    for name, changed in delta['set'].items():
+        data.setdefault(name, {}).update(changed)
+    for name, keys in delta.get('unset', {}).items():
+        for key in keys:
+            data[name].pop(key, None)
+
+def encode_header(global_data):
+    header = zlib.compress(json.dumps(global_data).encode('utf-8'))
+    return RECORD_MAGIC + RECORD_HEADER.pack(len(header)) + header
+
+def encode_frame(kind, payload, elapsed, now):
+    '''
+    Frames hold the time covered by each metric's counters, along with the
+    data: with per-metric or adaptive intervals, it is not the time between
+    two frames.
+    '''
+    payload = zlib.compress(json.dumps([elapsed, payload], separators=(',', ':')).encode('utf-8'))
+    return RECORD_FRAME.pack(kind, now, len(payload)) + payload
+
+def decode_frame(content):
+    '''
+    Return the (elapsed, payload) of an ``encode_frame()`` frame body
+    '''
+    elapsed, payload = json.loads(zlib.decompress(content).decode('utf-8'))
+    return elapsed, payload
+
+class Recorder(object):
+    '''
+    Append raw measures to ``path``, one zlib compressed JSON frame per
+    refresh. Frames only hold what changed since the previous one, except for
+    a full key frame every ``KEYFRAME_INTERVAL`` frames so that replay can
+    seek without reading the whole capture.
+    '''
+    KEYFRAME_INTERVAL = 60
+
+    def __init__(self, path, global_data):
+        self.file = open(path, 'wb')
+        self.prev = None
+        self.frames = 0
+
+        self.file.write(encode_header(global_data))
+
+    def write(self, measures, now):
+        if self.prev is None or self.frames % self.KEYFRAME_INTERVAL == 0:
+            kind, payload = FRAME_KEY, measures['data']
+        else:
+            kind, payload = FRAME_DELTA, frame_delta(self.prev, measures['data'])
+
+        self.file.write(encode_frame(kind, payload, measures.get('elapsed', {}), now))
+        self.file.flush()
+        self.prev = measures['data']
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+class Replayer(object):
+    '''
+    Play back a capture made by ``Recorder``. Only frame offsets are loaded in
+    memory. Sequential playback decodes one frame per refresh, seeking
+    decodes at most ``KEYFRAME_INTERVAL`` frames from the previous key frame.
+    '''
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        if self.file.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError("%s is not a ctop capture" % path)
+        length, = RECORD_HEADER.unpack(self.file.read(RECORD_HEADER.size))
+        self.global_data = json.loads(zlib.decompress(self.file.read(length)).decode('utf-8'))
+
+        # Index frames, skipping payloads
+        self.offsets, self.times, self.keyframes = [], [], []
+        while True:
+            header = self.file.read(RECORD_FRAME.size)
+            if len(header) < RECORD_FRAME.size:
+                break
+            kind, frame_time, length = RECORD_FRAME.unpack(header)
+            if kind == FRAME_KEY:
+                self.keyframes.append(len(self.offsets))
+            self.offsets.append(self.file.tell())
+            self.times.append(frame_time)
+            self.file.seek(length, os.SEEK_CUR)
+
+        # Truncated last frame, capture was interrupted
+        if self.offsets and self.file.tell() > os.fstat(self.file.fileno()).st_size:
+            self.offsets.pop()
+            self.times.pop()
+
+        if not self.offsets:
+            raise ValueError("%s is empty" % path)
+
+        self.pos = -1
+        self.data = {}
+        self.elapsed = {}
+
+    def _read(self, i):
+        self.file.seek(self.offsets[i] - RECORD_FRAME.size)
+        kind, _time, length = RECORD_FRAME.unpack(self.file.read(RECORD_FRAME.size))
+        elapsed, payload = decode_frame(self.file.read(length))
+        return kind, elapsed, payload
+
+    def seek(self, i):
+        '''
+        Make frame ``i`` the current frame
+        '''
+        if i == self.pos:
+            return
+
+        # Sequential read, else restart from the closest key frame
+        start = self.pos + 1
+        if i != self.pos + 1:
+            start = self.keyframes[bisect.bisect_right(self.keyframes, i) - 1]
+
+        for j in range(start, i + 1):
+            kind, self.elapsed, payload = self._read(j)
+            if kind == FRAME_KEY:
+                self.data = payload
+            else:
+                apply_frame_delta(self.data, payload)
+        self.pos = i
+
+    def step(self, measures, conf):
+        '''
+        Load the next frame, or the frame pointed by a pending seek, into
+        ``measures``. Return the time of this frame and the delay before the
+        next one, at the current replay speed.
+        '''
+        if conf['replay_seek'] and self.pos >= 0:
+            target = bisect.bisect_left(self.times, self.times[self.pos] + conf['replay_seek'])
+        else:
+            target = self.pos + 1
+        conf['replay_seek'] = 0
+
+        target = max(0, min(target, len(self.times) - 1))
+        if target == len(self.times) - 1 and target != self.pos:
+            # Hold the last frame
+            conf['pause_refresh'] = True
+        self.seek(target)
+
+        measures['global'].update(self.global_data)
+        measures['global']['time'] = self.times[target - 1] if target else self.times[0] - conf['refresh_interval']
+        measures['data'] = self.data
+        measures['elapsed'] = self.elapsed
+
+        if target + 1 < len(self.times):
+            delay = (self.times[target + 1] - self.times[target]) / conf['replay_speed']
+        else:
+            delay = conf['refresh_interval']
+        return self.times[target], delay
+
+    def status(self):
+        def hms(seconds):
+            seconds = int(seconds)
+            return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+        return "REPLAY %s/%s" % (hms(self.times[max(self.pos, 0)] - self.times[0]), hms(self.times[-1] - self.times[0]))
+
+## Agent / fan-in
+
+def parse_address(address):
+    '''
+    Parse '[host:]port' or a unix socket path. Return (family, address)
+    '''
+    if '/' in address:
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+def poll_sockets(readers, writers, timeout):
+    '''
+    Like select() on ``readers`` and ``writers``, sockets or descriptors, but
+    with poll(): cached stat files can push descriptors past FD_SETSIZE.
+    Return (readable, writable).
+    '''
+    events = {}
+    for obj in readers:
+        events[obj] = events.get(obj, 0) | select.POLLIN
+    for obj in writers:
+        events[obj] = events.get(obj, 0) | select.POLLOUT
+
+    poller = select.poll()
+    by_fd = {}
+    for obj, mask in events.items():
+        fd = obj if isinstance(obj, int) else obj.fileno()
+        by_fd[fd] = obj
+        poller.register(fd, mask)
+
+    readable, writable = [], []
+    for fd, event in poller.poll(timeout * 1000):
+        obj = by_fd[fd]
+        if event & (select.POLLIN | select.POLLHUP | select.POLLERR) and events[obj] & select.POLLIN:
+            readable.append(obj)
+        if event & (select.POLLOUT | select.POLLHUP | select.POLLERR) and events[obj] & select.POLLOUT:
+            writable.append(obj)
+    return readable, writable
+
+class AgentServer(threading.Thread):
+    '''
+    Stream measures to any number of viewers, over TCP or a unix socket. The
+    stream has the exact layout of a ``Recorder`` capture: global data, then
+    one frame per refresh. A viewer gets a key frame first, then deltas only,
+    so that bandwidth follows what changed. Frames are encoded once for all
+    viewers. Writes never block the agent: a viewer more than ``MAX_BACKLOG``
+    bytes behind is disconnected, and resyncs when it reconnects.
+    '''
+    MAX_BACKLOG = 8 * 1024 * 1024
+
+    def __init__(self, address, global_data):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.family, self.address = parse_address(address)
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_UNIX:
+            if os.path.exists(self.address) and stat.S_ISSOCK(os.stat(self.address).st_mode):
+                os.unlink(self.address)
+        else:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(16)
+
+        self.header = encode_header(global_data)
+        self.clients = {}       # socket -> pending output
+        self.fresh = set()      # sockets waiting for a key frame
+        self.lock = threading.Lock()
+        self.prev = None
+        self.stopped = False
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+    def publish(self, measures, now):
+        '''
+        Queue the frame of ``measures`` for every connected viewer
+        '''
+        data, elapsed = measures['data'], measures.get('elapsed', {})
+        key_frame, delta_frame = None, None
+        with self.lock:
+            for sock, pending in self.clients.items():
+                if sock in self.fresh or self.prev is None:
+                    if key_frame is None:
+                        key_frame = encode_frame(FRAME_KEY, data, elapsed, now)
+                    pending += key_frame
+                else:
+                    if delta_frame is None:
+                        delta_frame = encode_frame(FRAME_DELTA, frame_delta(self.prev, data), elapsed, now)
+                    pending += delta_frame
+            self.fresh.clear()
+        self.prev = data
+        os.write(self.wakeup_w, b'.')
+
+    def _drop(self, sock):
+        with self.lock:
+            self.clients.pop(sock, None)
+            self.fresh.discard(sock)
+        sock.close()
+
+    def run(self):
+        while not self.stopped:
+            with self.lock:
+                clients = list(self.clients)
+                writers = [sock for sock, pending in self.clients.items() if pending]
+            try:
+                readable, writable = poll_sockets([self.sock, self.wakeup_r] + clients, writers, 1)
+            except (select.error, ValueError):
+                # Closed by stop()
+                continue
+
+            for sock in readable:
+                if sock is self.sock:
+                    conn, _ = self.sock.accept()
+                    conn.setblocking(0)
+                    with self.lock:
+                        self.clients[conn] = bytearray(self.header)
+                        self.fresh.add(conn)
+                elif sock is self.wakeup_r:
+                    os.read(self.wakeup_r, 4096)
+                else:
+                    # Viewers never talk: this is a close or an error
+                    try:
+                        if sock.recv(4096):
+                            continue
+                    except socket.error as e:
+                        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            continue
+                    self._drop(sock)
+
+            for sock in writable:
+                with self.lock:
+                    pending = self.clients.get(sock)
+                    if pending is None:
+                        continue
+                    try:
+                        del pending[:sock.send(pending)]
+                    except socket.error as e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            pending = None
+                if pending is None or len(pending) > self.MAX_BACKLOG:
+                    self._drop(sock)
+
+    def stop(self):
+        self.stopped = True
+        for sock in list(self.clients):
+            self._drop(sock)
+        self.sock.close()
+        os.write(self.wakeup_w, b'.')
+        if self.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+class AgentStream(object):
+    '''
+    Connection to one agent. Decodes its stream incrementally and keeps the
+    rows of its latest frame, built with the agent's own global data and frame
+    times, and prefixed with '/<label>'.
+    '''
+    def __init__(self, spec):
+        label, _, address = spec.rpartition('=')
+        self.family, self.address = parse_address(address)
+        if not label:
+            label = os.path.basename(address) if self.family == socket.AF_UNIX else address
+        self.label = label
+        self.prefix = '/' + label
+        self.sock = None
+        self.connected = False
+        self.retry_at = 0
+        self.rows = []
+        self.reset()
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.measures = None
+
+    def connect(self):
+        self.reset()
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.connected = False
+        err = self.sock.connect_ex(self.address)
+        if err == 0:
+            self.connected = True
+        elif err not in (errno.EINPROGRESS, errno.EAGAIN, errno.EWOULDBLOCK):
+            self.close(time.time())
+
+    def close(self, now):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.connected = False
+        self.retry_at = now + FanIn.RETRY_INTERVAL
+        self.rows = []
+
+    def feed(self, chunk):
+        '''
+        Consume ``chunk`` of the stream. Raise ValueError on garbage.
+        '''
+        self.buffer += chunk
+        buf = self.buffer
+        pos = 0
+
+        if self.measures is None:
+            start = len(RECORD_MAGIC) + RECORD_HEADER.size
+            if len(buf) < start:
+                return
+            if bytes(buf[:len(RECORD_MAGIC)]) != RECORD_MAGIC:
+                raise ValueError("%s is not a ctop agent" % self.label)
+            length, = RECORD_HEADER.unpack_from(buf, len(RECORD_MAGIC))
+            if len(buf) < start + length:
+                return
+            global_data = json.loads(zlib.decompress(bytes(buf[start:start + length])).decode('utf-8'))
+            self.measures = {'global': global_data, 'data': {}}
+            pos = start + length
+
+        rows = None
+        while len(buf) - pos >= RECORD_FRAME.size:
+            kind, frame_time, length = RECORD_FRAME.unpack_from(buf, pos)
+            end = pos + RECORD_FRAME.size + length
+            if len(buf) < end:
+                break
+            self.measures['elapsed'], payload = decode_frame(bytes(buf[pos + RECORD_FRAME.size:end]))
+            if kind == FRAME_KEY:
+                self.measures['data'] = payload
+            else:
+                apply_frame_delta(self.measures['data'], payload)
+            pos = end
+
+            # Rates must be computed per frame, against this agent's clock
+            rows = built_statistics(self.measures, CONFIGURATION, frame_time, record_history=False)
+
+        del buf[:pos]
+        if rows is not None:
+            for line in rows:
+                line.host = self.label
+                line.cgroup = self.prefix + line.cgroup.rstrip('/')
+            self.rows = rows
+
+class FanIn(threading.Thread):
+    '''
+    Merge the streams of several agents into one table. A single thread
+    multiplexes all the connections with select(). Lost agents are retried
+    every ``RETRY_INTERVAL`` seconds, their rows are dropped meanwhile.
+    '''
+    RETRY_INTERVAL = 5
+    READ_SIZE = 65536
+
+    def __init__(self, specs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.agents = [AgentStream(spec) for spec in specs]
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            now = time.time()
+            for agent in self.agents:
+                if agent.sock is None and now >= agent.retry_at:
+                    agent.connect()
+
+            socks = dict((agent.sock, agent) for agent in self.agents if agent.sock is not None)
+            readers = [sock for sock, agent in socks.items() if agent.connected]
+            writers = [sock for sock, agent in socks.items() if not agent.connected]
+            if not socks:
+                time.sleep(0.5)
+                continue
+
+            readable, writable = poll_sockets(readers, writers, 0.5)
+            now = time.time()
+            for sock in writable:
+                # Non blocking connect completed
+                agent = socks[sock]
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    agent.close(now)
+                else:
+                    agent.connected = True
+
+            for sock in readable:
+                agent = socks[sock]
+                try:
+                    chunk = sock.recv(self.READ_SIZE)
+                    if not chunk:
+                        raise ValueError("connection closed")
+                    agent.feed(chunk)
+                except (socket.error, ValueError, zlib.error):
+                    agent.close(now)
+
+    def results(self):
+        '''
+        Rows of all agents, as of their latest frame
+        '''
+        merged = []
+        for agent in self.agents:
+            merged.extend(agent.rows)
+        return merged
+
+    def stop(self):
+        self.stopped = True
+
+## Alerting
+
+regexp_alert_rule = re.compile(r'^\s*(\w+)\s*(>=|<=|==|!=|>|<)\s*([-+]?[0-9]*\.?[0-9]+)\s*([%KMGT]?)(?:\s+for\s+([0-9]*\.?[0-9]+)s)?\s*$')
+ALERT_UNITS = {'': 1, '%': 0.01, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+# Numeric Row fields rules may use
+ALERT_FIELDS = [f for f in Row.__slots__ if f not in ('cgroup', 'host', 'owner', 'type', 'image', 'max_tasks', '_tree', '_history')]
+
+class AlertRule(object):
+    '''
+    Threshold rule, compiled once from '<field> <op> <value>[%|K|M|G|T] [for <N>s]'.
+    For instance 'cpu_total > 90% for 30s' or 'tasks_percent >= 0.9'.
+    '''
+    def __init__(self, text):
+        match = regexp_alert_rule.match(text)
+        if not match:
+            raise ValueError("cannot parse %r" % text)
+        field, self.op, value, unit, duration = match.groups()
+        if field not in ALERT_FIELDS:
+            raise ValueError("unknown field %r, expected one of %s" % (field, ', '.join(ALERT_FIELDS)))
+
+        self.text = text.strip()
+        self.field = field
+        self.threshold = float(value) * ALERT_UNITS[unit]
+        self.duration = float(duration or 0)
+
+    def select(self, rows, values):
+        '''
+        Return the rows matching this rule. ``rows`` are sorted on this rule's
+        field and ``values`` are the matching field values.
+        '''
+        if self.op in ('>', '<='):
+            pos = bisect.bisect_right(values, self.threshold)
+        else:
+            pos = bisect.bisect_left(values, self.threshold)
+
+        if self.op in ('>', '>='):
+            return rows[pos:]
+        elif self.op in ('<', '<='):
+            return rows[:pos]
+
+        end = bisect.bisect_right(values, self.threshold, pos)
+        if self.op == '==':
+            return rows[pos:end]
+        return rows[:pos] + rows[end:]
+
+class Alerts(object):
+    '''
+    Evaluate alert rules on each refresh. Each field used by any rule is read
+    once and its candidate rows sorted, so that each rule is a bisection
+    returning only the matching rows, instead of one comparison per rule and
+    cgroup.
+
+    A rule fires for a cgroup once it matched for ``duration`` seconds in a
+    row. ``firing`` maps each firing cgroup to its rules. It is replaced, never
+    mutated, so the UI thread may read it at any time.
+    '''
+    def __init__(self):
+        self.set_rules([])
+        self.sink = None
+
+    def set_rules(self, rules):
+        self.rules = [AlertRule(rule) for rule in rules]
+        self.by_field = defaultdict(list)
+        for rule in self.rules:
+            self.by_field[rule.field].append(rule)
+        self.pending = dict((rule, {}) for rule in self.rules)  # rule -> {cgroup: since}
+        self.active = dict((rule, set()) for rule in self.rules)
+        self.firing = {}
+
+    def evaluate(self, results, now):
+        firing = defaultdict(list)
+        events = []
+
+        for field, rules in self.by_field.items():
+            getter = operator.attrgetter(field)
+            rows, values = self._candidates(results, getter, rules)
+
+            for rule in rules:
+                pending = self.pending[rule]
+                matching = {}
+                active = set()
+                for row in rule.select(rows, values):
+                    since = matching[row.cgroup] = pending.get(row.cgroup, now)
+                    if now - since >= rule.duration:
+                        active.add(row.cgroup)
+                        firing[row.cgroup].append(rule.text)
+                        if row.cgroup not in self.active[rule]:
+                            events.append(self._event(now, 'firing', rule, row.cgroup, getter(row)))
+
+                for cgroup in self.active[rule] - active:
+                    events.append(self._event(now, 'resolved', rule, cgroup, None))
+                self.pending[rule] = matching
+                self.active[rule] = active
+
+        self.firing = dict(firing)
+        if events and self.sink is not None:
+            self.sink.send(events)
+        return events
+
+    def _candidates(self, results, getter, rules):
+        '''
+        Return the rows that may match any of ``rules``, sorted on their field,
+        and the field values. When all the rules bound the field on the same
+        side, rows beyond the loosest threshold are skipped before sorting.
+        '''
+        values = list(map(getter, results))
+        ops = set(rule.op for rule in rules)
+        if ops <= set(['>', '>=']):
+            lowest = min(rule.threshold for rule in rules)
+            keep = [i for i, value in enumerate(values) if value >= lowest]
+        elif ops <= set(['<', '<=']):
+            highest = max(rule.threshold for rule in rules)
+            keep = [i for i, value in enumerate(values) if value <= highest]
+        else:
+            keep = range(len(values))
+
+        keep = sorted(keep, key=values.__getitem__)
+        return [results[i] for i in keep], [values[i] for i in keep]
+
+    def _event(self, now, state, rule, cgroup, value):
+        return {'time': now, 'state': state, 'rule': rule.text, 'cgroup': cgroup, 'value': value}
+
+class AlertSink(threading.Thread):
+    '''
+    Deliver alert events to a JSON Lines ``log`` file and/or POST them as JSON
+    to a ``webhook`` URL, from a background thread so that a slow endpoint
+    never delays sampling. Events are dropped if the queue is full.
+    '''
+    QUEUE_SIZE = 1024
+    TIMEOUT = 5
+
+    def __init__(self, log=None, webhook=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.log = open(log, 'a') if log else None
+        self.webhook = webhook
+        self.queue = Queue(self.QUEUE_SIZE)
+        self.dropped = 0
+        self.errors = 0
+
+    def send(self, events):
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+            except Full:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+
+            body = json.dumps(event, separators=(',', ':'))
+            if self.log is not None:
+                self.log.write(body + '\n')
+                self.log.flush()
+            if self.webhook:
+                try:
+                    request = Request(self.webhook, body.encode('utf-8'), {'Content-Type': 'application/json'})
+                    urlopen(request, timeout=self.TIMEOUT).close()
+                except Exception:
+                    self.errors += 1
+
+    def stop(self):
+        '''
+        Deliver queued events, then stop. Give up after ``TIMEOUT`` seconds
+        if the webhook is too slow to drain the queue. Report lost events.
+        '''
+        pending = 0
+        try:
+            self.queue.put(None, timeout=self.TIMEOUT)
+            self.join(self.TIMEOUT)
+            pending = -1 # The stop marker
+        except Full:
+            pass
+        if self.is_alive():
+            self.dropped += max(0, self.queue.qsize() + pending)
+        elif self.log is not None:
+            self.log.close()
+
+        if self.dropped or self.errors:
+            print("[WARN] Alerts: %d events dropped, %d webhook errors" % (self.dropped, self.errors), file=sys.stderr)
+
+ALERTS = Alerts()
+
+## Headless export
+
+# Exported name, built_statistics() field, Prometheus type, help. Counters
+# are cumulative integers, rates are left to the consumer.
+EXPORT_METRICS = [
+    ('tasks',              'cur_tasks',          'gauge',   'Number of tasks in the cgroup'),
+    ('memory_bytes',       'memory_cur_bytes',   'gauge',   'Memory usage, excluding page cache, in bytes'),
+    ('memory_limit_bytes', 'memory_limit_bytes', 'gauge',   'Memory limit in bytes'),
+    ('cpu_user_usec',      'cpu_user_usec',      'counter', 'CPU time spent in user mode, in microseconds'),
+    ('cpu_system_usec',    'cpu_syst_usec',      'counter', 'CPU time spent in kernel mode, in microseconds'),
+    ('blkio_bytes',        'blkio_total_bytes',  'counter', 'Bytes read from and written to block devices'),
+    ('cpu_pressure_usec',    'cpu_pressure_usec',    'counter', 'Time some tasks were stalled waiting for CPU, in microseconds'),
+    ('memory_pressure_usec', 'memory_pressure_usec', 'counter', 'Time some tasks were stalled waiting for memory, in microseconds'),
+    ('io_pressure_usec',     'io_pressure_usec',     'counter', 'Time some tasks were stalled waiting for I/O, in microseconds'),
+    ('cpu_throttled_periods', 'nr_throttled_total',  'counter', 'Number of CPU bandwidth periods the cgroup was throttled'),
+    ('cpu_throttled_usec',   'throttled_usec',       'counter', 'Time the cgroup was throttled by CPU bandwidth control, in microseconds'),
+]
+EXPORT_LABELS = ['cgroup', 'type', 'owner']
+
+def export_record(results, now):
+    '''
+    Build a compact, JSON serializable record of ``results``
+    '''
+    cgroups = []
+    for line in results:
+        cgroup = dict((label, line[label]) for label in EXPORT_LABELS)
+        for name, field, _type, _help in EXPORT_METRICS:
+            cgroup[name] = line[field]
+        if isinstance(line['max_tasks'], int):
+            cgroup['pids_max'] = line['max_tasks']
+        cgroups.append(cgroup)
+    return {'time': round(now, 3), 'cgroups': cgroups}
+
+def prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def export_prometheus(results):
+    '''
+    Render ``results`` in Prometheus text exposition format
+    '''
+    lines = []
+    labels = [
+        ','.join('%s="%s"' % (label, prometheus_escape(line[label])) for label in EXPORT_LABELS)
+        for line in results
+    ]
+    for name, field, metric_type, metric_help in EXPORT_METRICS:
+        metric = 'ctop_' + name + ('_total' if metric_type == 'counter' else '')
+        lines.append('# HELP %s %s' % (metric, metric_help))
+        lines.append('# TYPE %s %s' % (metric, metric_type))
+        for line, line_labels in zip(results, labels):
+            lines.append('%s{%s} %d' % (metric, line_labels, line[field]))
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    Serve the latest metrics on '/metrics'
+    '''
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep stdout/stderr clean for JSON Lines output
+        pass
+
+def start_metrics_server(listen):
+    '''
+    Serve Prometheus metrics on ``listen``, '[address:]port', from a daemon
+    thread. Address defaults to localhost.
+    '''
+    address, _, port = listen.rpartition(':')
+    server = HTTPServer((address or '127.0.0.1', int(port)), MetricsHandler)
+    server.metrics = ''
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def headless(measures, jsonl=None, listen=None, recorder=None, serve=None):
+    '''
+    Run the collection pipeline without a screen. Emit one JSON Lines record
+    per refresh to ``jsonl``, a path or '-' for stdout, and/or serve
+    Prometheus metrics on ``listen``, and/or record to ``recorder``, and/or
+    stream measures to viewers connecting to ``serve``.
+    '''
+    server = start_metrics_server(listen) if listen else None
+    agent = None
+    if serve:
+        agent = AgentServer(serve, measures['global'])
+        agent.start()
+    if jsonl == '-':
+        output = sys.stdout
+    elif jsonl:
+        output = open(jsonl, 'a')
+    else:
+        output = None
+
+    try:
+        while True:
+            start = time.time()
+            collect(measures)
+            for phase, duration in measures['timings']:
+                TIMINGS.add(phase, duration)
+
+            build_start = monotonic()
+            results = built_statistics(measures, CONFIGURATION, start, SCHEDULE.history_due(start))
+            TIMINGS.add('build', monotonic() - build_start)
+            if recorder is not None:
+                recorder.write(measures, start)
+            if agent is not None:
+                agent.publish(measures, start)
+            if ALERTS.rules:
+                ALERTS.evaluate(results, start)
+            if CONFIGURATION['type']:
+                results = [l for l in results if l['type'] in CONFIGURATION['type']]
+
+            if output is not None:
+                output.write(json.dumps(export_record(results, start), separators=(',', ':')) + '\n')
+                output.flush()
+            if server is not None:
+                server.metrics = export_prometheus(results)
+
+            time.sleep(SCHEDULE.next_delay(time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if output is not None and output is not sys.stdout:
+            output.close()
+        if server is not None:
+            server.shutdown()
+        if agent is not None:
+            agent.stop()
+
+def print_timings(timings):
+    '''
+    Print average time spent per phase
+    '''
+    print("Average time per phase:", file=sys.stderr)
+    for phase in sorted(timings.last, key=lambda phase: -timings.average(phase)):
+        print("  {0: <14} {1: >8.2f}ms over {2} runs".format(phase, timings.average(phase) * 1000, timings.count[phase]), file=sys.stderr)
+
+def dump_profile(path, profilers):
+    '''
+    Merge ``profilers`` and save them to ``path``, for pstats, snakeviz, ...
+    Profilers must be disabled by the thread that enabled them.
+    '''
+    stats = None
+    for profiler in profilers:
+        if stats is None:
+            stats = pstats.Stats(profiler)
+        else:
+            stats.add(profiler)
+    stats.dump_stats(path)
+    print("Profile written to %s, inspect with: python -m pstats %s" % (path, path), file=sys.stderr)
+
 def init_screen():
     curses.start_color() # load colors
     curses.use_default_colors()
@@ -972,23 +3580,42 @@ def init_screen():
             pass
 
 def main():
+    # Needed by curses to draw non-ascii chars, like sparklines
+    locale.setlocale(locale.LC_ALL, '')
+
     # Parse arguments
     parser = OptionParser()
     parser.add_option("--tree",     action="store_true",                default=False, help="show tree view by default")
-    parser.add_option("--refresh",  action="store",      type="int",    default=1,     help="Refresh display every <seconds>")
+    parser.add_option("--refresh",  action="store",      type="float",  default=1.0,   help="Refresh display every <seconds>")
+    parser.add_option("--intervals", action="store",     type="string", default="",    help="Per metric sampling intervals, like 'cpu=0.5,owner=30'")
+    parser.add_option("--adaptive", action="store_true",                default=False, help="Stretch the interval of metrics slower to sample than their budget")
     parser.add_option("--follow",   action="store",      type="string", default="",    help="Follow cgroup path")
     parser.add_option("--fold",     action="append",                                   help="Fold cgroup sub tree")
     parser.add_option("--type",     action="append",                                   help="Only show containers of this type")
     parser.add_option("--columns",  action="store",      type="string", default="owner,type,processes,memory,cpu-sys,cpu-user,blkio,cpu-time", help="List of optional columns to display. Always includes 'name'")
     parser.add_option("--sort-col", action="store",      type="string", default="cpu-user", help="Select column to sort by initially. Can be changed dynamically.")
+    parser.add_option("--history",  action="store",      type="int",    default=60,    help="Number of refreshes kept in history columns")
+    parser.add_option("--record",   action="store",      type="string", default="",    help="Record raw measures to <file>")
+    parser.add_option("--replay",   action="store",      type="string", default="",    help="Replay measures recorded in <file>")
+    parser.add_option("--speed",    action="store",      type="float",  default=1.0,   help="Replay speed factor")
+    parser.add_option("--timings",  action="store_true",                default=False, help="Print average time per phase on exit")
+    parser.add_option("--profile",  action="store",      type="string", default="",    help="Save a cProfile dump to <file> on exit")
+    parser.add_option("--jsonl",    action="store",      type="string", default="",    help="Headless: append one JSON record per refresh to <file>, '-' for stdout")
+    parser.add_option("--listen",   action="store",      type="string", default="",    help="Headless: serve Prometheus metrics on [<address>:]<port>/metrics")
+    parser.add_option("--serve",    action="store",      type="string", default="",    help="Headless agent: stream measures to viewers on [<address>:]<port> or a unix socket path")
+    parser.add_option("--connect",  action="append",                                   help="Viewer: merge the agent at [<label>=][<address>:]<port> or a unix socket path. Repeat for each agent")
+    parser.add_option("--alert",    action="append",                                   help="Alert rule '<field> <op> <value>[%|K|M|G|T] [for <N>s]', like 'cpu_total > 90% for 30s'")
+    parser.add_option("--alert-log", action="store",     type="string", default="",    help="Append alert events as JSON Lines to <file>")
+    parser.add_option("--alert-webhook", action="store", type="string", default="",    help="POST alert events as JSON to <url>")
 
     options, args = parser.parse_args()
 
     CONFIGURATION['tree'] = options.tree
-    CONFIGURATION['refresh_interval'] = float(options.refresh)
+    CONFIGURATION['refresh_interval'] = options.refresh
     CONFIGURATION['columns'] = []
     CONFIGURATION['fold'] = options.fold or list()
     CONFIGURATION['type'] = options.type or list()
+    CONFIGURATION['history'] = HISTORY.window = max(1, options.history)
 
     if options.follow:
         CONFIGURATION['selected_line_name'] = options.follow
@@ -1011,6 +3638,17 @@ def main():
         sys.exit(1)
     CONFIGURATION['sort_by'] = COLUMNS_AVAILABLE[options.sort_col].col_sort
 
+    try:
+        SCHEDULE.configure(options.refresh, SamplingSchedule.parse(options.intervals), options.adaptive)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        ALERTS.set_rules(options.alert or [])
+    except ValueError as e:
+        print("[ERROR] Invalid alert rule:", e, file=sys.stderr)
+        sys.exit(1)
+
     # Initialization, global system data
     measures = {
         'data': defaultdict(dict),
@@ -1021,14 +3659,67 @@ def main():
         }
     }
 
-    init()
+    replayer = None
+    fanin = None
+    if options.connect:
+        try:
+            fanin = FanIn(options.connect)
+        except ValueError as e:
+            print("[ERROR] Invalid agent address:", e, file=sys.stderr)
+            sys.exit(1)
+        CONFIGURATION['remote'] = True
+        if 'host' not in CONFIGURATION['columns']:
+            CONFIGURATION['columns'].insert(0, 'host')
+            rebuild_columns()
+    elif options.replay:
+        try:
+            replayer = Replayer(options.replay)
+        except (IOError, ValueError) as e:
+            print("[ERROR] Failed to load capture:", e, file=sys.stderr)
+            sys.exit(1)
+        CONFIGURATION['replay'] = replayer
+        CONFIGURATION['replay_speed'] = options.speed
+    else:
+        init()
 
-    if not CGROUP_MOUNTPOINTS:
-        print("[ERROR] Failed to locate cgroup mountpoints.", file=sys.stderr)
-        diagnose()
-        sys.exit(1)
+        if not CGROUP_MOUNTPOINTS:
+            print("[ERROR] Failed to locate cgroup mountpoints.", file=sys.stderr)
+            diagnose()
+            sys.exit(1)
+
+    recorder = None
+    if options.record:
+        recorder = Recorder(options.record, measures['global'])
+
+    if options.alert_log or options.alert_webhook:
+        ALERTS.sink = AlertSink(options.alert_log, options.alert_webhook)
+        ALERTS.sink.start()
+
+    profiler = None
+    if options.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    if options.jsonl or options.listen or options.serve:
+        try:
+            headless(measures, options.jsonl, options.listen, recorder, options.serve)
+        finally:
+            if recorder is not None:
+                recorder.close()
+            if ALERTS.sink is not None:
+                ALERTS.sink.stop()
+        if profiler is not None:
+            profiler.disable()
+            dump_profile(options.profile, [profiler])
+        if options.timings:
+            print_timings(TIMINGS)
+        return
 
     results = None
+    # Before 3.12, profilers only see the thread that enabled them
+    sampler = Sampler(measures, replayer, recorder, fanin, profile=bool(options.profile) and not PROFILE_ALL_THREADS)
+    if fanin is not None:
+        fanin.start()
 
     try:
         # Curse initialization
@@ -1041,31 +3732,55 @@ def main():
         curses.init_pair(2, curses.COLOR_BLACK, curses.COLOR_CYAN)  # focused header / line
         curses.init_pair(3, curses.COLOR_WHITE, -1)  # regular
         curses.init_pair(4, curses.COLOR_CYAN,  -1)  # tree
+        curses.init_pair(5, curses.COLOR_WHITE, curses.COLOR_RED)  # alerting line
 
-        # Main loop
+        # Main loop: render latest snapshot, never wait for collection
+        sampler.start()
+        displayed = None
         while True:
-            collect(measures)
-            results = built_statistics(measures, CONFIGURATION)
-            display(stdscr, results, CONFIGURATION)
-            sleep_start = time.time()
-            while CONFIGURATION['pause_refresh'] or time.time() < sleep_start + CONFIGURATION['refresh_interval']:
-                if CONFIGURATION['pause_refresh']:
-                    to_sleep = -1
-                else:
-                    to_sleep = int((sleep_start + CONFIGURATION['refresh_interval'] - time.time())*1000)
-                ret = event_listener(stdscr, to_sleep)
-                if ret == 2:
-                    display(stdscr, results, CONFIGURATION)
+            snapshot = sampler.latest()
+            if snapshot is not None and snapshot is not displayed:
+                results = snapshot.results
+                display(stdscr, results, CONFIGURATION, snapshot.processes)
+                displayed = snapshot
+
+            ret = event_listener(stdscr, INPUT_TIMEOUT)
+            if ret != 1 or CONFIGURATION['replay_seek']:
+                # Pause, seek, drill-down... may change sampling
+                sampler.wakeup.set()
+            if ret == 2 and results is not None:
+                display(stdscr, results, CONFIGURATION, displayed.processes)
     except KeyboardInterrupt:
         pass
     finally:
+        sampler.stop()
+        if fanin is not None:
+            fanin.stop()
         curses.nocbreak()
         stdscr.keypad(0)
         curses.echo()
         curses.endwin()
+        if recorder is not None or profiler is not None:
+            sampler.join(1)
+        if recorder is not None:
+            recorder.close()
+        if ALERTS.sink is not None:
+            ALERTS.sink.stop()
+
+    if profiler is not None:
+        profiler.disable()
+        profilers = [profiler]
+        # Skip the sampler's profiler if it never ran, or still runs
+        if sampler.profiler is not None and sampler.profiler.getstats() and not sampler.is_alive():
+            profilers.append(sampler.profiler)
+        dump_profile(options.profile, profilers)
+    if options.timings and TIMINGS.count:
+        print_timings(TIMINGS)
+    if options.timings and FRAME.frames:
+        print("Average screen output: %d bytes/frame over %d frames" % (FRAME.total_bytes_written / FRAME.frames, FRAME.frames), file=sys.stderr)
 
     # If we found only root cgroup, me may be expecting to run in a boot2docker instance
-    if results is not None and len(results) < 2:
+    if results is not None and len(results) < 2 and fanin is None:
         print("[WARN] Failed to find any relevant cgroup/container.", file=sys.stderr)
         diagnose()
 
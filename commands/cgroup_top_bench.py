@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmark cgroup_top against synthetic cgroup trees.
+
+Generate cgroup v1 and/or v2 trees of the requested sizes in a temporary
+directory, point cgroup_top at them and time each stage of a refresh:
+collect(), built_statistics(), prepare_tree() and display() on a fake curses
+screen. Results are written as JSON, to compare runs and track regressions.
+
+Usage:
+  cgroup_top_bench.py [--sizes=<sizes>] [--depth=<depth>] [--versions=<versions>] [--iterations=<n>] [--output=<file>] [--screen=<h>x<w>] [--tree] [--keep]
+
+Options:
+  --sizes=<sizes>        Comma separated number of cgroups per tree [default: 100,1000,10000].
+  --depth=<depth>        Maximum depth of the trees [default: 4].
+  --versions=<versions>  Comma separated cgroup versions to generate, 'v1' and/or 'v2' [default: v1,v2].
+  --iterations=<n>       Timed refreshes per tree, after a cold one [default: 5].
+  --output=<file>        Write JSON results to <file>, '-' for stdout [default: -].
+  --screen=<h>x<w>       Size of the fake screen [default: 50x200].
+  --tree                 Benchmark tree view instead of list view.
+  --keep                 Keep generated trees.
+  -h --help              Show this screen.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import multiprocessing
+
+from collections import defaultdict
+from optparse import OptionParser
+from timeit import default_timer as timer
+
+import cgroup_top
+
+# Controllers mounted, one hierarchy each, on a v1 system
+V1_CONTROLLERS = ['cpuacct', 'cpu', 'blkio', 'memory', 'pids']
+
+PHASES = ['collect', 'built_statistics', 'prepare_tree', 'display']
+
+## Synthetic trees
+
+def tree_paths(count, depth):
+    '''
+    Return ``count`` cgroup paths, root included, spread breadth first over at
+    most ``depth`` levels
+    '''
+    fanout = 2
+    while sum(fanout ** level for level in range(depth + 1)) < count:
+        fanout += 1
+
+    paths = ['/']
+    parents = ['/']
+    while len(paths) < count and parents:
+        children = []
+        for parent in parents:
+            for i in range(fanout):
+                if len(paths) == count:
+                    break
+                path = os.path.join(parent, 'cg%d' % len(paths))
+                paths.append(path)
+                children.append(path)
+        parents = children
+    return paths
+
+def write_files(directory, files):
+    for name, content in files.items():
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(content)
+
+def pressure(total):
+    return 'some avg10=0.00 avg60=0.00 avg300=0.00 total=%d\nfull avg10=0.00 avg60=0.00 avg300=0.00 total=%d\n' % (total, total // 2)
+
+def v1_files(controller, is_root, pids, rand):
+    files = {'tasks': ''.join('%d\n' % pid for pid in pids)}
+    if controller == 'cpuacct':
+        files['cpuacct.stat'] = 'user %d\nsystem %d\n' % (rand.randint(0, 10**7), rand.randint(0, 10**6))
+    elif controller == 'cpu':
+        files['cpu.stat'] = 'nr_periods %d\nnr_throttled %d\nthrottled_time %d\n' % (
+            rand.randint(0, 10**5), rand.randint(0, 10**3), rand.randint(0, 10**9))
+    elif controller == 'blkio':
+        read, write = rand.randint(0, 10**9), rand.randint(0, 10**9)
+        files['blkio.throttle.io_service_bytes'] = ''.join([
+            '8:0 Read %d\n' % read,
+            '8:0 Write %d\n' % write,
+            '8:0 Sync %d\n' % write,
+            '8:0 Async %d\n' % read,
+            '8:0 Total %d\n' % (read + write),
+            'Total %d\n' % (read + write),
+        ])
+    elif controller == 'memory':
+        usage = rand.randint(10**6, 10**9)
+        files['memory.stat'] = 'cache %d\nrss %d\nmapped_file %d\n' % (usage // 4, usage // 2, usage // 8)
+        files['memory.usage_in_bytes'] = '%d\n' % usage
+        files['memory.limit_in_bytes'] = '%d\n' % (2**63 - 4096 if rand.random() < 0.5 else usage * 2)
+    elif controller == 'pids' and not is_root:
+        files['pids.max'] = 'max\n' if rand.random() < 0.5 else '%d\n' % rand.randint(100, 10000)
+    return files
+
+def v2_files(is_root, pids, rand):
+    user, system = rand.randint(0, 10**10), rand.randint(0, 10**9)
+    read, write = rand.randint(0, 10**9), rand.randint(0, 10**9)
+    files = {
+        'cgroup.procs': ''.join('%d\n' % pid for pid in pids),
+        'cpu.stat': 'usage_usec %d\nuser_usec %d\nsystem_usec %d\nnr_periods %d\nnr_throttled %d\nthrottled_usec %d\n' % (
+            user + system, user, system, rand.randint(0, 10**5), rand.randint(0, 10**3), rand.randint(0, 10**8)),
+        'io.stat': '8:0 rbytes=%d wbytes=%d rios=%d wios=%d dbytes=0 dios=0\n' % (read, write, read // 4096, write // 4096),
+    }
+    if not is_root:
+        usage = rand.randint(10**6, 10**9)
+        files['memory.current'] = '%d\n' % usage
+        files['memory.stat'] = 'anon %d\nfile %d\nkernel_stack %d\n' % (usage // 2, usage // 4, usage // 64)
+        files['memory.max'] = 'max\n' if rand.random() < 0.5 else '%d\n' % (usage * 2)
+        files['pids.max'] = 'max\n' if rand.random() < 0.5 else '%d\n' % rand.randint(100, 10000)
+        for resource in ('cpu', 'memory', 'io'):
+            files[resource + '.pressure'] = pressure(rand.randint(0, 10**8))
+    return files
+
+def generate(base, version, count, depth, seed=0):
+    '''
+    Generate a tree of ``count`` cgroups under ``base``. Return the cgroup
+    mountpoints, as ``cgroup_top.init()`` would find them.
+    '''
+    rand = random.Random(seed)
+    paths = tree_paths(count, depth)
+    pids = [os.getpid()]
+
+    if version == 'v2':
+        mountpoints = {'unified': os.path.join(base, 'unified')}
+    else:
+        mountpoints = dict((controller, os.path.join(base, controller)) for controller in V1_CONTROLLERS)
+
+    for controller, mountpoint in mountpoints.items():
+        for path in paths:
+            directory = mountpoint + path.rstrip('/')
+            if path != '/':
+                os.mkdir(directory)
+            else:
+                os.makedirs(directory)
+
+            if version == 'v2':
+                write_files(directory, v2_files(path == '/', pids, rand))
+            else:
+                write_files(directory, v1_files(controller, path == '/', pids, rand))
+
+    return mountpoints
+
+## Fake screen
+
+class FakeCurses(object):
+    '''
+    Stand-in for the curses module: ``display()`` needs color pairs, line
+    drawing chars and ``doupdate()``, which all require a terminal.
+    '''
+    def __init__(self, real):
+        self.real = real
+        for i, name in enumerate(['ACS_VLINE', 'ACS_HLINE', 'ACS_LTEE', 'ACS_LLCORNER']):
+            setattr(self, name, 0x400000 + i)
+
+    def __getattr__(self, name):
+        return getattr(self.real, name)
+
+    def color_pair(self, n):
+        return n << 8
+
+    def doupdate(self):
+        pass
+
+class FakeScreen(object):
+    '''
+    Window of ``height`` x ``width`` cells discarding its output. Counts the
+    bytes that would have been sent to the terminal.
+    '''
+    def __init__(self, height, width):
+        self.height, self.width = height, width
+        self.bytes_written = 0
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def erase(self):
+        pass
+
+    def addstr(self, y, x, text, attr=0):
+        self.bytes_written += len(text.encode('utf-8'))
+
+    def addch(self, y, x, ch, attr=0):
+        self.bytes_written += 1
+
+    def noutrefresh(self):
+        pass
+
+## Benchmark
+
+def reset(mountpoints, history):
+    '''
+    Reset cgroup_top global state, and point it at ``mountpoints``
+    '''
+    for tree in cgroup_top.CGROUP_TREES.values():
+        if tree.inotify is not None:
+            tree.inotify.close()
+    cgroup_top.CGROUP_TREES.clear()
+    cgroup_top.CGROUP_MOUNTPOINTS.clear()
+    cgroup_top.CGROUP_MOUNTPOINTS.update(mountpoints)
+    cgroup_top.STAT_FILES.retain(())
+    cgroup_top.HISTORY = cgroup_top.History(history)
+    cgroup_top.TREE = cgroup_top.TreeIndex()
+    cgroup_top.FRAME = cgroup_top.ScreenBuffer()
+    cgroup_top.VIEW_CACHE.update(key=None, results=None, rendered=[], cgroups=[], index={})
+    # Sample every metric on every pass, owner lookups included
+    cgroup_top.SCHEDULE.configure(1e-9, {'owner': 1e-9, 'openvz': 1e-9})
+    cgroup_top.SCHEDULE.last.clear()
+    cgroup_top.METADATA.clear()
+
+def summary(samples):
+    ordered = sorted(samples)
+    return {
+        'min': ordered[0],
+        'median': ordered[len(ordered) // 2],
+        'max': ordered[-1],
+    }
+
+def bench_tree(mountpoints, iterations, screen):
+    '''
+    Time one cold and ``iterations`` warm refreshes of the tree at ``mountpoints``
+    '''
+    conf = cgroup_top.CONFIGURATION
+    reset(mountpoints, conf['history'])
+    measures = {
+        'data': defaultdict(dict),
+        'global': {
+            'total_cpu': multiprocessing.cpu_count(),
+            'total_memory': cgroup_top.get_total_memory(),
+            'scheduler_frequency': os.sysconf('SC_CLK_TCK'),
+        }
+    }
+
+    timings = defaultdict(list)
+    collect_phases = defaultdict(list)
+    cgroups = 0
+    for i in range(iterations + 1):
+        start = timer()
+        cgroup_top.collect(measures)
+        collect_time = timer() - start
+
+        start = timer()
+        results = cgroup_top.built_statistics(measures, conf)
+        statistics_time = timer() - start
+
+        ordered = sorted(results, key=lambda line: getattr(line, conf['sort_by']), reverse=not conf['sort_asc'])
+        start = timer()
+        cgroup_top.prepare_tree(ordered)
+        tree_time = timer() - start
+
+        # Measure rendering only: sort and tree are cached by then
+        cgroup_top.prepare_view(results, conf)
+        start = timer()
+        cgroup_top.display(screen, results, conf)
+        display_time = timer() - start
+
+        if i == 0:
+            cold = {'collect': collect_time, 'built_statistics': statistics_time,
+                    'prepare_tree': tree_time, 'display': display_time}
+            continue
+
+        timings['collect'].append(collect_time)
+        timings['built_statistics'].append(statistics_time)
+        timings['prepare_tree'].append(tree_time)
+        timings['display'].append(display_time)
+        for phase, duration in measures['timings']:
+            collect_phases[phase].append(duration)
+        cgroups = len(results)
+
+    return {
+        'cgroups': cgroups,
+        'cold': cold,
+        'phases': dict((phase, summary(timings[phase])) for phase in PHASES),
+        'collect_phases': dict((phase, summary(samples)) for phase, samples in collect_phases.items()),
+        'screen_bytes': cgroup_top.FRAME.total_bytes_written // max(1, cgroup_top.FRAME.frames),
+    }
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--sizes",      action="store", type="string", default="100,1000,10000", help="Comma separated number of cgroups per tree")
+    parser.add_option("--depth",      action="store", type="int",    default=4,      help="Maximum depth of the trees")
+    parser.add_option("--versions",   action="store", type="string", default="v1,v2", help="Comma separated cgroup versions to generate, 'v1' and/or 'v2'")
+    parser.add_option("--iterations", action="store", type="int",    default=5,      help="Timed refreshes per tree, after a cold one")
+    parser.add_option("--output",     action="store", type="string", default="-",    help="Write JSON results to <file>, '-' for stdout")
+    parser.add_option("--screen",     action="store", type="string", default="50x200", help="Size of the fake screen, <height>x<width>")
+    parser.add_option("--tree",       action="store_true",           default=False,  help="Benchmark tree view instead of list view")
+    parser.add_option("--keep",       action="store_true",           default=False,  help="Keep generated trees")
+    options, args = parser.parse_args()
+
+    try:
+        sizes = [int(size) for size in options.sizes.split(',')]
+        height, width = [int(v) for v in options.screen.split('x')]
+    except ValueError:
+        print(__doc__)
+        sys.exit(1)
+    versions = [v.strip() for v in options.versions.split(',')]
+    if any(v not in ('v1', 'v2') for v in versions) or options.iterations < 1:
+        print(__doc__)
+        sys.exit(1)
+
+    # Same defaults as ctop, without a terminal. Do not query the Docker daemon.
+    cgroup_top.curses = FakeCurses(cgroup_top.curses)
+    cgroup_top.HAS_DOCKER = False
+    cgroup_top.CONFIGURATION['tree'] = options.tree
+    cgroup_top.CONFIGURATION['columns'] = ['owner', 'type', 'processes', 'memory', 'cpu-sys', 'cpu-user', 'blkio', 'cpu-time']
+    cgroup_top.CONFIGURATION['sort_by'] = cgroup_top.COLUMNS_AVAILABLE['cpu-user'].col_sort
+    cgroup_top.rebuild_columns()
+
+    report = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'tree_view': options.tree,
+        'iterations': options.iterations,
+        'screen': [height, width],
+        'results': [],
+    }
+
+    base = tempfile.mkdtemp(prefix='ctop-bench-')
+    try:
+        for version in versions:
+            for size in sizes:
+                root = os.path.join(base, '%s-%d' % (version, size))
+                start = timer()
+                mountpoints = generate(root, version, size, options.depth)
+                generation_time = timer() - start
+
+                result = bench_tree(mountpoints, options.iterations, FakeScreen(height, width))
+                result.update(version=version, size=size, depth=options.depth, generation=generation_time)
+                report['results'].append(result)
+                print("%s %6d cgroups: %s" % (version, size, ', '.join(
+                    '%s %.2fms' % (phase, result['phases'][phase]['median'] * 1000) for phase in PHASES)), file=sys.stderr)
+
+                if not options.keep:
+                    reset({}, cgroup_top.CONFIGURATION['history'])
+                    shutil.rmtree(root)
+    finally:
+        if options.keep:
+            print("Trees kept in", base, file=sys.stderr)
+        else:
+            shutil.rmtree(base, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output == '-':
+        print(output)
+    else:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == "__main__":
+    main()
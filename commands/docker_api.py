@@ -0,0 +1,172 @@
+from __future__ import print_function, unicode_literals
+from urllib.parse import quote
+from docker import DockerClient
+from docker.constants import IS_WINDOWS_PLATFORM
+from docker.utils import kwargs_from_env, parse_host
+import asyncio
+import json
+import os
+import httpx
+
+
+# Connections kept open to the daemon, and requests in flight at once
+MAX_CONNECTIONS = 8
+MAX_CONCURRENCY = 16
+
+
+def convert_filters(filters):
+    """
+    Filters as the daemon expects them: every value a list of strings
+    """
+    converted = {}
+    for name, value in filters.items():
+        if not isinstance(value, list):
+            value = [value]
+        converted[name] = [str(v).lower() if isinstance(v, bool) else str(v) for v in value]
+    return json.dumps(converted)
+
+
+class UnsupportedDockerHost(Exception):
+    pass
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class DockerAPI:
+    """
+    Minimal asyncio Docker Engine API client. Requests share a pool of
+    `max_connections` keep-alive connections to the daemon, and at most
+    `max_concurrency` of them are in flight, so that fanning out one request
+    per container does not flood the daemon.
+
+    The daemon address, TLS settings, API version and timeout are the ones
+    of the docker-py `client`, as configured by `docker.from_env()`. Unix
+    sockets and tcp hosts, with or without TLS, are supported.
+
+        async with DockerAPI(client) as api:
+            containers = await api.containers(all=True)
+    """
+
+    def __init__(self, client: DockerClient, max_connections=MAX_CONNECTIONS, max_concurrency=MAX_CONCURRENCY):
+        # docker-py only keeps the resolved address of tcp hosts: resolve
+        # DOCKER_HOST the same way it does
+        tls = kwargs_from_env().get('tls')
+        host = parse_host(os.environ.get('DOCKER_HOST'), IS_WINDOWS_PLATFORM, tls=bool(tls))
+        limits = httpx.Limits(max_connections=max_connections,
+                              max_keepalive_connections=max_connections)
+        if host.startswith('http+unix://'):
+            transport = httpx.AsyncHTTPTransport(uds=host[len('http+unix://'):], limits=limits)
+            base_url = 'http://docker'
+        elif host.startswith(('http://', 'https://')):
+            # Same TLS settings as the docker-py session
+            verify = client.api.verify if client.api.verify is not None else True
+            transport = httpx.AsyncHTTPTransport(verify=verify, cert=client.api.cert, limits=limits)
+            base_url = host
+        else:
+            raise UnsupportedDockerHost(
+                f"Docker host '{host}' is not supported, use a unix:// or tcp:// DOCKER_HOST")
+        self.client = httpx.AsyncClient(transport=transport, base_url=f"{base_url}/v{client.api.api_version}",
+                                        timeout=client.api.timeout)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def get(self, path, **params):
+        """
+        GET `path` and return the decoded JSON body. Filters are JSON
+        encoded, booleans sent as 0/1 and None values dropped, as the
+        daemon expects.
+        """
+        query = {}
+        for name, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            elif isinstance(value, dict):
+                value = convert_filters(value)
+            query[name] = value
+
+        async with self.semaphore:
+            response = await self.client.get(path, params=query)
+        if response.status_code >= 400:
+            try:
+                message = response.json().get('message', response.text)
+            except ValueError:
+                message = response.text
+            raise DockerAPIError(response.status_code, message)
+        return response.json()
+
+    async def containers(self, all=False, filters=None, limit=None):
+        """
+        List containers, summary only: one request whatever their number
+        """
+        return await self.get('/containers/json', all=all, filters=filters or None, limit=limit)
+
+    async def container_stats(self, container_id):
+        """
+        Single stats sample. `one-shot` skips the second sample the daemon
+        would otherwise wait about a second for, to compute CPU usage.
+        """
+        return await self.get(f"/containers/{quote(container_id)}/stats", **{'stream': False, 'one-shot': True})
+
+    async def images(self, all=False, filters=None):
+        """
+        List images, summary only: one request whatever their number
+        """
+        return await self.get('/images/json', all=all, filters=filters or None)
+
+
+class ImageTags:
+    """
+    Process-wide image ID -> tags cache. Filled from one image list
+    request, instead of one image inspect per container, and marked stale
+    by image events (pull, tag, untag, delete, ...) so that the next user
+    lists images again.
+    """
+
+    # Image events that change the ID -> tags mapping
+    EVENTS = ['pull', 'tag', 'untag', 'delete', 'import', 'load']
+
+    def __init__(self):
+        self.tags = {}
+        self.stale = True
+
+    def update(self, images):
+        """
+        Replace the cache with image list summaries, as returned by
+        `DockerAPI.images()`
+        """
+        self.tags = {}
+        for image in images:
+            self.tags[image['Id']] = [tag for tag in image.get('RepoTags') or [] if tag != '<none>:<none>']
+        self.stale = False
+
+    async def load(self, api: DockerAPI):
+        if self.stale:
+            self.update(await api.images())
+
+    def invalidate(self):
+        self.stale = True
+
+    def name(self, image_id, default):
+        """
+        First tag of `image_id`, or `default` if it has none
+        """
+        tags = self.tags.get(image_id)
+        return tags[0] if tags else default
+
+
+IMAGE_TAGS = ImageTags()
@@ -5,12 +5,16 @@ from rich.table import Table
 from rich.console import Console
 from dateutil.parser import parse
 from datetime import datetime, timezone
-import concurrent.futures
-import json
+from commands.docker_api import DockerAPI, IMAGE_TAGS
+import asyncio
 
 
 def format_time(time_str):
-    time = parse(time_str)
+    # The list endpoints give UNIX timestamps, inspect gives RFC 3339 strings
+    if isinstance(time_str, (int, float)):
+        time = datetime.fromtimestamp(time_str, timezone.utc)
+    else:
+        time = parse(time_str)
     now = datetime.now(timezone.utc)
     diff = now - time
 
@@ -40,21 +44,35 @@ def format_size(size):
 
 
 def get_image_info(image):
-    created = format_time(image.attrs['Created'])
-    size = format_size(image.attrs['Size'])
-    tags = ', '.join(image.tags)
+    created = format_time(image['Created'])
+    size = format_size(image['Size'])
+    tags = ', '.join(IMAGE_TAGS.tags.get(image['Id'], []))
 
     return {
-        "ID": image.short_id,
+        "ID": image['Id'][:17],
         "Created": created,
         "Size": size,
         "Tags": tags
     }
 
 
+async def list_images(client: DockerClient):
+    """
+    One request for all images, instead of an inspect per image. Also
+    refreshes the image tags cache.
+    """
+    async with DockerAPI(client) as api:
+        images = await api.images()
+    IMAGE_TAGS.update(images)
+    return images
+
+
 def images(client: DockerClient | None):
     try:
-        images = client.images.list()
+        if client is None:
+            raise ValueError("Docker client is not initialized.")
+
+        images = asyncio.run(list_images(client))
 
         console = Console()
         table = Table(show_header=True, header_style="bold magenta")
@@ -1,16 +1,28 @@
 from __future__ import print_function, unicode_literals
 from PyInquirer import prompt
 from docker import DockerClient
+from docker.errors import DockerException
+from requests.exceptions import RequestException
 from rich.table import Table
 from rich.console import Console
+from rich.live import Live
 from dateutil.parser import parse
 from datetime import datetime, timezone
-import concurrent.futures
+from commands.docker_api import DockerAPI, DockerAPIError, ImageTags, IMAGE_TAGS
+import asyncio
+import threading
+import queue
 import json
+import time
+import sys
 
 
 def format_time(time_str):
-    time = parse(time_str)
+    # The list endpoints give UNIX timestamps, inspect gives RFC 3339 strings
+    if isinstance(time_str, (int, float)):
+        time = datetime.fromtimestamp(time_str, timezone.utc)
+    else:
+        time = parse(time_str)
     now = datetime.now(timezone.utc)
     diff = now - time
 
@@ -39,108 +51,466 @@ def format_size(size):
     return f"{size_gb:.2f}GB"
 
 
-def get_container_stats(container):
-    created = format_time(container.attrs['Created'])
-    status = container.status
-    ports = container.attrs['NetworkSettings']['Ports']
-    image = container.image.tags[0] if container.image.tags else container.image.id
+def format_ports(ports):
+    # Like `docker ps`: 0.0.0.0:8080->80/tcp
+    formatted = []
+    for port in ports or []:
+        if 'PublicPort' in port:
+            formatted.append(f"{port.get('IP', '')}:{port['PublicPort']}->{port['PrivatePort']}/{port['Type']}")
+        else:
+            formatted.append(f"{port['PrivatePort']}/{port['Type']}")
+    return formatted
 
-    stats = container.stats(stream=False)
-    memory_usage = format_size(stats['memory_stats']['usage'])
+
+async def get_container_stats(api: DockerAPI, container, sparse, ignore_removed):
+    """
+    Raw row of one container, from its list summary. Unless `sparse`,
+    running containers cost one extra request, for their memory usage.
+    Return None when the container vanished and `ignore_removed` is set.
+    """
+    memory_usage = None
+    if not sparse and container['State'] == 'running':
+        try:
+            stats = await api.container_stats(container['Id'])
+        except DockerAPIError as e:
+            if e.status == 404 and ignore_removed:
+                return None
+            raise
+        memory_usage = stats['memory_stats'].get('usage', 0)
 
     return {
-        "ID": container.short_id,
-        "Name": container.name,
-        "Created": created,
-        "Status": status,
-        "Ports": ports,
-        "Image": image,
+        "ID": container['Id'][:12],
+        "Name": container['Names'][0].lstrip('/'),
+        "Created": container['Created'],
+        "Status": container['State'],
+        "Ports": format_ports(container.get('Ports')),
+        "Image": IMAGE_TAGS.name(container['ImageID'], container['Image']),
         "Memory Usage": memory_usage
     }
 
 
-def ps(client: DockerClient | None):
+async def iter_containers(client: DockerClient, options):
+    """
+    Yield container rows as soon as each one is complete, fastest first.
+    One request to list containers, one for image tags if not cached, then
+    at most one per running container for stats, through a bounded
+    connection pool.
+    """
+    async with DockerAPI(client) as api:
+        # Filtered and limited by the daemon: stats are only fetched for
+        # the containers that are displayed. Like `docker ps -n`, a limit
+        # lists the last created containers in any state.
+        containers = await api.containers(all=options['all'], filters=options['filters'], limit=options['limit'])
+        await IMAGE_TAGS.load(api)
+        rows = [get_container_stats(api, container, options['sparse'], options['ignore_removed'])
+                for container in containers]
+        for row in asyncio.as_completed(rows):
+            row = await row
+            if row is not None:
+                yield row
+
+
+async def print_ndjson(client: DockerClient, options):
+    async for row in iter_containers(client, options):
+        print(json.dumps(row), flush=True)
+
+
+async def list_containers(client: DockerClient, options):
+    # Newest first, like the daemon lists them
+    rows = [row async for row in iter_containers(client, options)]
+    return sorted(rows, key=lambda row: row["Created"], reverse=True)
+
+
+def print_table(rows):
+    console = Console()
+    table = Table(show_header=True, header_style="bold magenta")
+    table.add_column("ID")
+    table.add_column("Name")
+    table.add_column("Created")
+    table.add_column("Status")
+    table.add_column("Ports")
+    table.add_column("Image")
+    table.add_column("Memory Usage")
+
+    for container_info in rows:
+        memory_usage = container_info["Memory Usage"]
+        table.add_row(
+            container_info["ID"],
+            container_info["Name"],
+            format_time(container_info["Created"]),
+            container_info["Status"],
+            ', '.join(container_info["Ports"]),
+            container_info["Image"],
+            format_size(memory_usage) if memory_usage is not None else "-"
+        )
+
+    console.print(table)
+
+
+# Upper bound on concurrently open stats streams in watch mode
+MAX_STATS_STREAMS = 32
+
+# Seconds before reopening the stats stream of a container whose stream failed
+STATS_RETRY_DELAY = 5
+
+# Container events that add or remove a row in watch mode
+WATCH_EVENTS = ['start', 'die', 'destroy']
+
+
+def summarize_stats(stats):
+    """
+    Reduce one decoded stats sample to the columns of the watch table.
+    The daemon includes the previous sample in `precpu_stats`, so the CPU
+    percentage needs no state of our own.
+    """
+    cpu_stats = stats.get('cpu_stats') or {}
+    precpu_stats = stats.get('precpu_stats') or {}
+    cpu_delta = cpu_stats.get('cpu_usage', {}).get('total_usage', 0) - \
+        precpu_stats.get('cpu_usage', {}).get('total_usage', 0)
+    system_delta = cpu_stats.get('system_cpu_usage', 0) - \
+        precpu_stats.get('system_cpu_usage', 0)
+    online_cpus = cpu_stats.get('online_cpus') or \
+        len(cpu_stats.get('cpu_usage', {}).get('percpu_usage') or []) or 1
+    cpu_percent = 0.0
+    if cpu_delta > 0 and system_delta > 0:
+        cpu_percent = cpu_delta / system_delta * online_cpus * 100.0
+
+    # Same as `docker stats`: page cache is not counted as used memory
+    memory_stats = stats.get('memory_stats') or {}
+    memory_detail = memory_stats.get('stats') or {}
+    memory_usage = memory_stats.get('usage', 0) - \
+        memory_detail.get('inactive_file', memory_detail.get('cache', 0))
+
+    net_rx = net_tx = 0
+    for network in (stats.get('networks') or {}).values():
+        net_rx += network.get('rx_bytes', 0)
+        net_tx += network.get('tx_bytes', 0)
+
+    block_read = block_write = 0
+    for entry in (stats.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []:
+        if entry.get('op', '').lower() == 'read':
+            block_read += entry.get('value', 0)
+        elif entry.get('op', '').lower() == 'write':
+            block_write += entry.get('value', 0)
+
+    return {
+        "CPU %": f"{cpu_percent:.2f}%",
+        "Memory Usage": f"{format_size(max(0, memory_usage))} / {format_size(memory_stats.get('limit', 0))}",
+        "Net I/O": f"{format_size(net_rx)} / {format_size(net_tx)}",
+        "Block I/O": f"{format_size(block_read)} / {format_size(block_write)}",
+    }
+
+
+class StatsStream(threading.Thread):
+    """
+    Follow one container's stats stream and keep its latest sample.
+    The daemon sends a sample about every second, until the container stops.
+    """
+
+    def __init__(self, client: DockerClient, container_id):
+        threading.Thread.__init__(self, daemon=True)
+        self.client = client
+        self.container_id = container_id
+        self.latest = None
+        self.stopped = False
+
+    def run(self):
+        try:
+            for stats in self.client.api.stats(self.container_id, stream=True, decode=True):
+                if self.stopped:
+                    break
+                self.latest = summarize_stats(stats)
+        except Exception:
+            # Container removed under our feet, the event will drop the row
+            pass
+
+    def stop(self):
+        # The stream can not be interrupted, the thread exits on next sample
+        self.stopped = True
+
+
+def follow_events(client: DockerClient, stream, events, filters):
+    """
+    Push (action, container id, attributes) for each container starting
+    or stopping in the events `stream` to the `events` queue, and mark the
+    image tags cache stale on image changes. The events endpoint does not
+    know all the container list filters, started containers are matched
+    against them with a list call.
+
+    Errors, including the end of the stream, are pushed as ('error', None,
+    exception), for the main loop to raise.
+    """
+    try:
+        for event in stream:
+            if event.get('Type') == 'image':
+                IMAGE_TAGS.invalidate()
+                continue
+            actor = event.get('Actor') or {}
+            container_id = actor.get('ID')
+            if event.get('Action') == 'start' and filters and \
+                    not client.api.containers(quiet=True, filters=dict(filters, id=container_id)):
+                continue
+            events.put((event.get('Action'), container_id, actor.get('Attributes') or {}))
+        raise RuntimeError("Docker events stream closed")
+    except Exception as e:
+        events.put(('error', None, e))
+    finally:
+        stream.close()
+
+
+def build_watch_table(rows, streams):
+    table = Table(show_header=True, header_style="bold magenta")
+    table.add_column("ID")
+    table.add_column("Name")
+    table.add_column("Image")
+    table.add_column("CPU %", justify="right")
+    table.add_column("Memory Usage", justify="right")
+    table.add_column("Net I/O", justify="right")
+    table.add_column("Block I/O", justify="right")
+
+    for container_id, row in rows.items():
+        stream = streams.get(container_id)
+        stats = stream.latest if stream is not None else None
+        if stats is None:
+            # Waiting for a first sample, or over the stream budget
+            stats = {"CPU %": "-", "Memory Usage": "-", "Net I/O": "-", "Block I/O": "-"}
+        table.add_row(
+            container_id[:12],
+            row["Name"],
+            IMAGE_TAGS.name(row["ImageID"], row["Image"]),
+            stats["CPU %"],
+            stats["Memory Usage"],
+            stats["Net I/O"],
+            stats["Block I/O"]
+        )
+    return table
+
+
+def watch(client: DockerClient, filters, max_streams=MAX_STATS_STREAMS):
+    """
+    Live table of running containers, fed by one persistent stats stream
+    per container (at most `max_streams`) instead of one blocking one-shot
+    stats call per container and refresh. Rows follow container events.
+    """
+    # Subscribe before listing, so that no container start is missed: the
+    # events request is sent before this call returns
+    stream = client.events(decode=True, filters={
+        'type': ['container', 'image'],
+        'event': WATCH_EVENTS + ImageTags.EVENTS,
+    })
+    events = queue.Queue()
+    threading.Thread(target=follow_events, args=(client, stream, events, filters), daemon=True).start()
+
+    rows = {}
+    for container in client.containers.list(filters=filters, sparse=True):
+        rows[container.id] = {
+            "Name": container.attrs['Names'][0].lstrip('/'),
+            "Image": container.attrs['Image'],
+            "ImageID": container.attrs['ImageID'],
+        }
+
+    streams = {}
+    # Stopped streams still blocked on a read, they hold a connection
+    stopping = []
+    # Container id -> time before which its failed stream is not reopened
+    retry_at = {}
+    with Live(build_watch_table(rows, streams), refresh_per_second=2) as live:
+        while True:
+            while True:
+                try:
+                    action, container_id, attributes = events.get_nowait()
+                except queue.Empty:
+                    break
+                if action == 'error':
+                    raise attributes
+                if action == 'start':
+                    rows[container_id] = {
+                        "Name": attributes.get('name', ''),
+                        "Image": attributes.get('image', ''),
+                        "ImageID": None,
+                    }
+                else:
+                    rows.pop(container_id, None)
+
+            # Streams follow rows, within budget
+            now = time.time()
+            for container_id in list(streams):
+                if not streams[container_id].is_alive():
+                    # Failed or ended: back off before reopening it
+                    del streams[container_id]
+                    retry_at[container_id] = now + STATS_RETRY_DELAY
+                elif container_id not in rows:
+                    stream = streams.pop(container_id)
+                    stream.stop()
+                    stopping.append(stream)
+            stopping = [stream for stream in stopping if stream.is_alive()]
+            for container_id in list(retry_at):
+                if container_id not in rows or retry_at[container_id] <= now:
+                    del retry_at[container_id]
+            for container_id in rows:
+                if len(streams) + len(stopping) >= max_streams:
+                    break
+                if container_id not in streams and container_id not in retry_at:
+                    streams[container_id] = StatsStream(client, container_id)
+                    streams[container_id].start()
+
+            if IMAGE_TAGS.stale:
+                try:
+                    IMAGE_TAGS.update(client.api.images())
+                except (DockerException, RequestException):
+                    # Keep showing the stale tags, retry on next tick
+                    pass
+
+            live.update(build_watch_table(rows, streams))
+            time.sleep(0.5)
+
+
+# Values of the 'status' filter known to the Engine API
+CONTAINER_STATUSES = ['created', 'restarting', 'running', 'removing', 'paused', 'exited', 'dead']
+
+
+def parse_filters(values):
+    """
+    Filters from repeated `key=value` flags, as lists of values per key
+    """
+    filters = {}
+    for value in values or []:
+        key, separator, filter_value = value.partition('=')
+        if not separator:
+            raise ValueError(f"Invalid filter '{value}', expected key=value")
+        filters.setdefault(key, []).append(filter_value)
+    return filters
+
+
+def options_from_args(args):
+    """
+    ps options from command line flags. None when no flag is given from a
+    terminal: the options are then prompted for, as before.
+    """
+    flags = [args.all, args.since, args.before, args.limit, args.filter,
+             args.label, args.status, args.ancestor,
+             args.sparse, args.ignore_removed, args.format != 'table']
+    if not any(flags) and sys.stdin.isatty() and sys.stdout.isatty():
+        return None
+
+    try:
+        filters = parse_filters(args.filter)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    for key in ('label', 'status', 'ancestor'):
+        filters.setdefault(key, []).extend(getattr(args, key) or [])
+        if not filters[key]:
+            del filters[key]
+    for status in filters.get('status', []):
+        if status not in CONTAINER_STATUSES:
+            print(f"Invalid status '{status}', expected one of {', '.join(CONTAINER_STATUSES)}", file=sys.stderr)
+            sys.exit(2)
+
+    return {
+        'all': args.all,
+        'since': args.since,
+        'before': args.before,
+        'limit': args.limit,
+        'filters': filters,
+        'sparse': args.sparse,
+        'ignore_removed': args.ignore_removed,
+        'format': args.format,
+    }
+
+
+def prompt_options(watch_mode):
+    questions = [
+        {
+            'type': 'confirm',
+            'name': 'all',
+            'message': 'Show all containers?',
+            'default': False
+        },
+        {
+            'type': 'input',
+            'name': 'since',
+            'message': 'Show only containers created since Id or Name (leave blank for none):',
+        },
+        {
+            'type': 'input',
+            'name': 'before',
+            'message': 'Show only containers created before Id or Name (leave blank for none):',
+        },
+        {
+            'type': 'input',
+            'name': 'limit',
+            'message': 'Show only the last created containers, in any state (leave blank for no limit):',
+        },
+        {
+            'type': 'input',
+            'name': 'filters',
+            'message': 'Enter any filters in JSON format (leave blank for none):',
+        },
+        {
+            'type': 'confirm',
+            'name': 'sparse',
+            'message': 'Do not inspect containers (no memory usage)?',
+            'default': False
+        },
+        {
+            'type': 'confirm',
+            'name': 'ignore_removed',
+            'message': 'Ignore failures due to missing containers?',
+            'default': False
+        },
+    ]
+
+    if watch_mode:
+        # Only running containers have stats to stream
+        questions = [q for q in questions if q['name'] == 'filters']
+
+    answers = prompt(questions)
+
+    return {
+        'all': answers.get('all', False),
+        'since': answers.get('since'),
+        'before': answers.get('before'),
+        'limit': int(answers['limit']) if answers.get('limit') else None,
+        'filters': json.loads(answers['filters']) if answers['filters'] else {},
+        'sparse': answers.get('sparse', False),
+        'ignore_removed': answers.get('ignore_removed', False),
+        'format': 'table',
+    }
+
+
+def ps(client: DockerClient | None, options=None, watch_mode=False):
+    interactive = options is None
     try:
         if client is None:
             raise ValueError("Docker client is not initialized.")
 
-        questions = [
-            {
-                'type': 'confirm',
-                'name': 'all',
-                'message': 'Show all containers?',
-                'default': False
-            },
-            {
-                'type': 'input',
-                'name': 'since',
-                'message': 'Show only containers created since Id or Name (leave blank for none):',
-            },
-            {
-                'type': 'input',
-                'name': 'before',
-                'message': 'Show only containers created before Id or Name (leave blank for none):',
-            },
-            {
-                'type': 'input',
-                'name': 'limit',
-                'message': 'Limit the number of containers to show (leave blank for no limit):',
-            },
-            {
-                'type': 'input',
-                'name': 'filters',
-                'message': 'Enter any filters in JSON format (leave blank for none):',
-            },
-            {
-                'type': 'confirm',
-                'name': 'sparse',
-                'message': 'Do not inspect containers?',
-                'default': False
-            },
-            {
-                'type': 'confirm',
-                'name': 'ignore_removed',
-                'message': 'Ignore failures due to missing containers?',
-                'default': False
-            },
-        ]
-
-        answers = prompt(questions)
-
-        filters = {}
-        if answers['since']:
-            filters['since'] = answers['since']
-        if answers['before']:
-            filters['before'] = answers['before']
-        if answers['filters']:
-            filters.update(json.loads(answers['filters']))
-
-        containers = client.containers.list(
-            all=answers['all'], filters=filters)
-
-        console = Console()
-        table = Table(show_header=True, header_style="bold magenta")
-        table.add_column("ID")
-        table.add_column("Name")
-        table.add_column("Created")
-        table.add_column("Status")
-        table.add_column("Ports")
-        table.add_column("Image")
-        table.add_column("Memory Usage")
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            for container_info in executor.map(get_container_stats, containers):
-                table.add_row(
-                    container_info["ID"],
-                    container_info["Name"],
-                    container_info["Created"],
-                    container_info["Status"],
-                    str(container_info["Ports"]),
-                    container_info["Image"],
-                    container_info["Memory Usage"]
-                )
-
-        console.print(table)
+        if interactive:
+            options = prompt_options(watch_mode)
+
+        filters = dict(options['filters'])
+        if options['since']:
+            filters['since'] = options['since']
+        if options['before']:
+            filters['before'] = options['before']
+        options['filters'] = filters
+
+        if watch_mode:
+            watch(client, filters)
+            return
+
+        if options['format'] == 'ndjson':
+            # One line per container, as soon as its stats are in
+            asyncio.run(print_ndjson(client, options))
+        elif options['format'] == 'json':
+            print(json.dumps(asyncio.run(list_containers(client, options)), indent=2))
+        else:
+            print_table(asyncio.run(list_containers(client, options)))
 
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
-        print('예외가 발생했습니다.', e)
+        print('예외가 발생했습니다.', e, file=sys.stderr)
+        if not interactive:
+            # Let scripts notice
+            sys.exit(1)
@@ -2,7 +2,7 @@ import argparse
 import docker
 from commands.exec import exec
 from commands.images import images
-from commands.ps import ps
+from commands.ps import ps, options_from_args
 from commands.run import run
 from commands.push import push
 from commands.pull import pull
@@ -42,6 +42,31 @@ def main():
         COMMANDS['BUILD'], help='Build image')
     ps_parser = subparsers.add_parser(
         COMMANDS['PS'], help='List containers')
+    ps_parser.add_argument(
+        '-a', '--all', action='store_true', help='Show all containers, not only running ones')
+    ps_parser.add_argument(
+        '--since', help='Show only containers created since Id or Name')
+    ps_parser.add_argument(
+        '--before', help='Show only containers created before Id or Name')
+    ps_parser.add_argument(
+        '-n', '--limit', type=int, help='Show the last created containers, in any state, like docker ps -n')
+    ps_parser.add_argument(
+        '-f', '--filter', action='append', help='Filter containers, like status=exited. Repeatable')
+    ps_parser.add_argument(
+        '--label', action='append', help='Only containers with this label, key or key=value. Repeatable')
+    ps_parser.add_argument(
+        '--status', action='append', help='Only containers in this state, like exited. Repeatable')
+    ps_parser.add_argument(
+        '--ancestor', action='append', help='Only containers created from this image or a descendant. Repeatable')
+    ps_parser.add_argument(
+        '--sparse', action='store_true', help='Do not fetch stats, no memory usage')
+    ps_parser.add_argument(
+        '--ignore-removed', action='store_true', help='Ignore failures due to missing containers')
+    ps_parser.add_argument(
+        '--format', choices=['table', 'json', 'ndjson'], default='table',
+        help='Output format. ndjson prints each container as soon as it is ready')
+    ps_parser.add_argument(
+        '--watch', action='store_true', help='Live view of running containers stats')
     images_parser = subparsers.add_parser(
         COMMANDS['IMAGES'], help='List images')
     top_parser=subparsers.add_parser(
@@ -60,7 +85,7 @@ def main():
     elif args.command == COMMANDS['EXEC']:
         exec(client)
     elif args.command == COMMANDS['PS']:
-        ps(client)
+        ps(client, options_from_args(args), watch_mode=args.watch)
     elif args.command == COMMANDS['IMAGES']:
         images(client)
     elif args.command==COMMANDS['TOP']: